@@ -0,0 +1,263 @@
+'''Benchmark suite for the pipeline stages on synthetic recordings.
+
+Generates a recording of the requested length and speech density offline, times each stage on it and
+writes throughput, real-time factor and peak RSS as JSON. With --baseline the run is compared against
+a stored result and the exit code is 1 when any stage regressed by more than --tolerance.
+
+    python benchmark.py --duration 600 --speech-density 0.3 --output bench.json
+    python benchmark.py --baseline bench_baseline.json
+    python benchmark.py --update-baseline bench_baseline.json
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import subprocess
+import tempfile
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use('Agg')
+
+from config import sample_rate, model_name, compute_type, segmentation, asr_engine
+from utils import extract_audio, split_audio, chunk_ranges, save_chunk
+from instrument import peak_rss_mb
+
+logging.basicConfig(level=logging.INFO)
+
+# Stage times only mean something against a baseline run with the same recording and models
+COMPARED_PARAMS = ["duration", "speech_density", "model_name", "compute_type", "segmentation", "asr_engine"]
+STAGES = ["extract_audio", "split_audio", "is_speech", "speech_regions", "model_load", "whisper", "get_sentiment", "visualization"]
+PHRASES = ["okay", "yes", "turn left here", "got it", "watch the car ahead", "slow down please", "that was close",
+           "nice and smooth", "I can't see the sign", "brake now", "good job", "keep going straight", "hmm"]
+
+
+def synth_recording(duration, speech_density, sr=sample_rate, seed=0):
+    '''Function that generates a float32 recording of engine hum with speech-like bursts.
+    Bursts are voiced harmonic buzz with a syllable-rate envelope and cover about speech_density of the time'''
+    rng = np.random.default_rng(seed)
+    n = int(duration * sr)
+    t = np.arange(n) / sr
+    audio = 0.01 * np.sin(2 * np.pi * 50 * t) + 0.005 * np.sin(2 * np.pi * 100 * t) + 0.003 * rng.standard_normal(n)
+
+    pos = 0.0
+    while pos < duration:
+        burst = rng.uniform(0.5, 4.0)
+        gap = burst * (1 - speech_density) / max(speech_density, 1e-3)
+        pos += rng.uniform(0.5, 1.5) * gap
+        start, end = int(pos * sr), min(int((pos + burst) * sr), n)
+        if start >= n:
+            break
+        tb = t[start:end] - t[start]
+        f0 = rng.uniform(100, 220) * (1 + 0.1 * np.sin(2 * np.pi * 0.5 * tb))
+        phase = 2 * np.pi * np.cumsum(f0) / sr
+        voiced = sum(np.sin(k * phase) / k for k in range(1, 12))
+        envelope = np.clip(np.sin(2 * np.pi * rng.uniform(3, 6) * tb), 0, None) ** 0.5
+        audio[start:end] += 0.2 * envelope * voiced + 0.02 * envelope * rng.standard_normal(end - start)
+        pos += burst
+
+    return np.clip(audio, -1.0, 1.0).astype(np.float32)
+
+
+def make_video(wav_path, video_path):
+    '''Function that muxes a WAV into an MP4 with a black video track so extract_audio sees a real recording'''
+    cmd = ["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-f", "lavfi", "-i", "color=c=black:s=64x64:r=1",
+           "-i", wav_path, "-shortest", "-c:v", "libx264", "-c:a", "aac", video_path]
+    subprocess.run(cmd, check=True)
+
+
+def timed(results, name, fn, audio_seconds=None, items=None):
+    '''Function that runs one stage, records its metrics in results and returns its output'''
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    output = fn()
+    seconds = time.perf_counter() - start
+    rss_after = peak_rss_mb()
+    entry = {"seconds": round(seconds, 4)}
+    if rss_before is not None and rss_after is not None:
+        # Only the process high-water mark is available, so this is how far the stage raised it: a stage that
+        # stays below the peak of an earlier stage reports 0. Run it alone with --stages to see its own peak
+        entry["peak_rss_increase_mb"] = round(rss_after - rss_before, 1)
+    if audio_seconds:
+        entry["audio_seconds"] = audio_seconds
+        entry["rtf"] = round(seconds / audio_seconds, 5)
+        entry["x_realtime"] = round(audio_seconds / seconds, 2) if seconds else None
+    if items is not None:
+        entry["items"] = items
+        entry["items_per_second"] = round(items / seconds, 2) if seconds else None
+    results[name] = entry
+    logging.info(f"{name}: {entry}")
+    return output
+
+
+def run(duration, speech_density, stages, workdir, seed=0):
+    '''Function that runs the selected stages on a synthetic recording and returns the result dict'''
+    results = {}
+    audio = synth_recording(duration, speech_density, seed=seed)
+
+    wav_path = os.path.join(workdir, "synthetic.wav")
+    save_chunk(audio, wav_path)
+
+    if "extract_audio" in stages:
+        video_path = os.path.join(workdir, "synthetic.mp4")
+        make_video(wav_path, video_path)
+        extracted_dir = os.path.join(workdir, "extracted")
+        os.makedirs(extracted_dir, exist_ok=True)
+        timed(results, "extract_audio", lambda: extract_audio(video_path, os.path.join(extracted_dir, "synthetic.wav")),
+              audio_seconds=duration)
+
+    if "split_audio" in stages:
+        audio_dir = os.path.join(workdir, "audio")
+        os.makedirs(audio_dir, exist_ok=True)
+        shutil.copy(wav_path, audio_dir)
+        timed(results, "split_audio", lambda: split_audio(audio_dir, os.path.join(workdir, "segments")),
+              audio_seconds=duration)
+
+    units = chunk_ranges(len(audio))
+
+    if "is_speech" in stages or "speech_regions" in stages or "whisper" in stages:
+        import stt
+
+        timed(results, "model_load", stt.warm_up)
+
+        if "is_speech" in stages:
+            timed(results, "is_speech", lambda: [stt.is_speech(audio[s:e]) for s, e in units],
+                  audio_seconds=duration, items=len(units))
+
+        if "speech_regions" in stages or segmentation == "vad":
+            regions = timed(results, "speech_regions", lambda: stt.speech_regions(audio), audio_seconds=duration)
+            results["speech_regions"]["items"] = len(regions)
+            if segmentation == "vad":
+                units = regions
+
+        if "whisper" in stages:
+            if asr_engine == "batched":
+                timed(results, "whisper", lambda: stt.transcribe_batched(audio, units, "synthetic"),
+                      audio_seconds=duration, items=len(units))
+            else:
+                timed(results, "whisper", lambda: [stt.transcribe_unit(audio[s:e], s, f"synthetic_{i}.wav")
+                                                  for i, (s, e) in enumerate(units)],
+                      audio_seconds=duration, items=len(units))
+
+    rng = np.random.default_rng(seed)
+    n_rows = max(int(duration * speech_density / 2), 1)
+    transcript_csv = os.path.join(workdir, "transcript.csv")
+    pd.DataFrame({
+        "file": [f"synthetic_{i}.wav" for i in range(n_rows)],
+        "start": np.sort(rng.uniform(0, duration, n_rows)),
+        "transcription": rng.choice(PHRASES, n_rows),
+    }).to_csv(transcript_csv, index=False)
+
+    if "get_sentiment" in stages:
+        import sentiment
+        from cache import ResultCache
+
+        sentiment.warm_up()
+        # Cold run: without this, texts memoized by warm_up, earlier runs or the shared result cache would be
+        # looked up instead of run through the model
+        sentiment._memo.clear()
+        shared_cache = sentiment.get_cache
+        isolated = ResultCache(os.path.join(workdir, "cache.sqlite"))
+        sentiment.get_cache = lambda: isolated
+        try:
+            timed(results, "get_sentiment", lambda: sentiment.get_sentiment(transcript_csv, transcript_csv), items=n_rows)
+        finally:
+            sentiment.get_cache = shared_cache
+            isolated.conn.close()
+
+    if "visualization" in stages:
+        from visualization import generate_time_bucket_histogram, generate_sentiment_visualization
+
+        if "get_sentiment" not in stages:
+            df = pd.read_csv(transcript_csv)
+            df["sentiment"] = rng.choice(["NEG", "NEU", "POS"], n_rows)
+            df.to_csv(transcript_csv, index=False)
+
+        def render():
+            for generate in (generate_time_bucket_histogram, generate_sentiment_visualization):
+                plot = generate(transcript_csv)
+                if plot is not None:
+                    plot.savefig(os.path.join(workdir, "plot.png"))
+                    plot.close()
+
+        timed(results, "visualization", render, items=n_rows)
+
+    return results
+
+
+def mismatched_params(params, baseline):
+    '''Function that returns {param: (value, baseline value)} for the settings that make two runs incomparable'''
+    base = baseline.get("params", {})
+    return {key: (params.get(key), base.get(key)) for key in COMPARED_PARAMS if params.get(key) != base.get(key)}
+
+
+def compare(results, baseline, tolerance):
+    '''Function that returns the stages whose time grew by more than tolerance over the baseline'''
+    regressions = []
+    for stage, entry in results.items():
+        base = baseline.get("stages", {}).get(stage)
+        if base and base["seconds"] > 0 and entry["seconds"] > base["seconds"] * (1 + tolerance):
+            regressions.append({"stage": stage, "seconds": entry["seconds"], "baseline_seconds": base["seconds"],
+                                "change": round(entry["seconds"] / base["seconds"] - 1, 3)})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on a synthetic recording")
+    parser.add_argument("--duration", type=float, default=300, help="Recording length in seconds")
+    parser.add_argument("--speech-density", type=float, default=0.3, help="Fraction of the recording with speech")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON result here instead of stdout")
+    parser.add_argument("--baseline", help="Compare against this stored result")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown per stage, 0.2 = 20%%")
+    parser.add_argument("--update-baseline", metavar="PATH", help="Store this run as the baseline at PATH")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="commsim_bench_")
+    try:
+        stages = run(args.duration, args.speech_density, args.stages, workdir, seed=args.seed)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "params": {"duration": args.duration, "speech_density": args.speech_density, "seed": args.seed,
+                   "model_name": model_name, "compute_type": compute_type, "segmentation": segmentation,
+                   "asr_engine": asr_engine},
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "stages": stages,
+        "peak_rss_mb": peak_rss_mb(),  # high-water mark of the whole run
+    }
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        mismatched = mismatched_params(report["params"], baseline)
+        if mismatched:
+            logging.error(f"Not comparing against {args.baseline}, it was run with different settings (now, baseline): {mismatched}")
+            report["mismatched_params"] = mismatched
+            exit_code = 2
+        else:
+            report["regressions"] = compare(stages, baseline, args.tolerance)
+            exit_code = 1 if report["regressions"] else 0
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.update_baseline:
+        with open(args.update_baseline, "w") as f:
+            f.write(text)
+
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
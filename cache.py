@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import argparse
+import functools
+import threading
+import numpy as np
+from config import CACHE_PATH, use_cache, cache_max_bytes, shared_filesystem
+
+logging.basicConfig(level=logging.INFO)
+
+
+def content_key(*parts):
+    '''Function that hashes audio buffers, bytes and JSON-serialisable parameters into a cache key'''
+    h = hashlib.blake2b(digest_size=20)
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            h.update(np.ascontiguousarray(part).view(np.uint8))
+        elif isinstance(part, bytes):
+            h.update(part)
+        else:
+            h.update(json.dumps(part, sort_keys=True, default=str).encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def file_digest(path, block_size=1 << 20):
+    '''Function that hashes a file's contents without reading it into memory at once'''
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ResultCache:
+    '''SQLite-backed store of pipeline results keyed by content hash. Entries are grouped by kind
+    ("recording", "unit", "vad", ...) and the least recently used ones are evicted above max_bytes.'''
+
+    def __init__(self, path=CACHE_PATH, max_bytes=cache_max_bytes):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        if not shared_filesystem:
+            # WAL relies on shared memory between processes on one host, network filesystems need the rollback journal
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+                                 kind TEXT NOT NULL,
+                                 key TEXT NOT NULL,
+                                 value TEXT NOT NULL,
+                                 size INTEGER NOT NULL,
+                                 accessed REAL NOT NULL,
+                                 PRIMARY KEY (kind, key))""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self.conn.commit()
+
+    def get(self, kind, key):
+        '''Returns the cached value, or None on a miss'''
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM entries WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE entries SET accessed = ? WHERE kind = ? AND key = ?", (time.time(), kind, key))
+            self.conn.commit()
+        return json.loads(row[0])
+
+    def get_many(self, kind, keys, chunk_size=500):
+        '''Returns {key: value} for the keys of one kind that are cached, in as few queries as possible'''
+        keys = list(keys)
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), chunk_size):
+                chunk = keys[i:i + chunk_size]
+                marks = ",".join("?" * len(chunk))
+                rows = self.conn.execute(f"SELECT key, value FROM entries WHERE kind = ? AND key IN ({marks})",
+                                         (kind, *chunk)).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self.conn.executemany("UPDATE entries SET accessed = ? WHERE kind = ? AND key = ?",
+                                      [(now, kind, key) for key in found])
+                self.conn.commit()
+        return {key: json.loads(value) for key, value in found.items()}
+
+    def put(self, kind, key, value):
+        '''Stores a JSON-serialisable value and evicts old entries if the cache grew past max_bytes'''
+        data = json.dumps(value, default=str)
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                              (kind, key, data, len(data), time.time()))
+            self._evict()
+            self.conn.commit()
+
+    def put_many(self, kind, items):
+        '''Stores {key: value} pairs of one kind in a single transaction'''
+        now = time.time()
+        rows = []
+        for key, value in items.items():
+            data = json.dumps(value, default=str)
+            rows.append((kind, key, data, len(data), now))
+        with self._lock:
+            self.conn.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", rows)
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for kind, key, size in self.conn.execute("SELECT kind, key, size FROM entries ORDER BY accessed").fetchall():
+            self.conn.execute("DELETE FROM entries WHERE kind = ? AND key = ?", (kind, key))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def invalidate(self, kind=None):
+        '''Removes every entry, or only the entries of one kind. Returns the number of entries removed'''
+        with self._lock:
+            if kind is None:
+                removed = self.conn.execute("DELETE FROM entries").rowcount
+            else:
+                removed = self.conn.execute("DELETE FROM entries WHERE kind = ?", (kind,)).rowcount
+            self.conn.commit()
+        return removed
+
+    def stats(self):
+        '''Returns {kind: (entries, bytes)}'''
+        with self._lock:
+            rows = self.conn.execute("SELECT kind, COUNT(*), SUM(size) FROM entries GROUP BY kind").fetchall()
+        return {kind: (count, size) for kind, count, size in rows}
+
+    def file_digest(self, path):
+        '''Returns the content digest of a file, hashing it only when its path, mtime or size changed since the
+        digest was stored under kind "digest"'''
+        st = os.stat(path)
+        key = content_key(os.path.abspath(path), st.st_mtime_ns, st.st_size)
+        digest = self.get("digest", key)
+        if digest is None:
+            digest = file_digest(path)
+            self.put("digest", key, digest)
+        return digest
+
+
+@functools.lru_cache(maxsize=None)
+def get_cache():
+    '''Function that opens the result cache on first use, or returns None when use_cache is off'''
+    if not use_cache:
+        return None
+    return ResultCache()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or invalidate the pipeline result cache")
+    parser.add_argument("command", choices=["stats", "invalidate"])
+    parser.add_argument("--kind", help="Only invalidate entries of this kind (recording, unit, vad, sentiment, digest)")
+    args = parser.parse_args()
+
+    cache = ResultCache()
+    if args.command == "invalidate":
+        removed = cache.invalidate(args.kind)
+        logging.info(f"Removed {removed} cache entries from {cache.path}")
+    else:
+        for kind, (count, size) in sorted(cache.stats().items()):
+            print(f"{kind}: {count} entries, {size / 1e6:.1f} MB")
@@ -2,6 +2,71 @@ VIDEO_PATH = "Videos"
 AUDIO_PATH = "Audios"
 SEG_PATH = "Segments"
 TRANSCRIBE_DIR = "Transcriptions"
+MODEL_CACHE_DIR = "Models"  # Whisper, silero VAD and sentiment weights are cached here and loaded offline once present
 
 model_name = "tiny"
-split_length = 5000
\ No newline at end of file
+compute_type = "int8"
+sentiment_model = "finiteautomata/bertweet-base-sentiment-analysis"
+split_length = 5000
+sample_rate = 16000
+
+extract_wav = True  # Write Audios/<name>.wav first. False, or pcm_store with in_memory, decodes the videos straight into the in-memory pipeline
+decode_block_seconds = 30  # Seconds of PCM read from ffmpeg per block while decoding
+
+in_memory = True  # Decode each recording once and pass chunks to VAD/Whisper as NumPy slices
+pcm_store = True  # Keep each decoded recording as SEG_PATH/<name>.npy (float32, memory-mapped) plus a .json sidecar, decoded only when the source changes
+save_segments = False  # Also write the chunks to SEG_PATH as WAV files (debug output for in_memory mode)
+
+segmentation = "vad"  # "vad": transcribe silero speech regions, "fixed": transcribe split_length blocks
+vad_window = 600000  # ms of audio handed to silero per call in the whole-recording VAD pass
+max_region_length = 30000  # ms, speech regions longer than this are cut
+region_merge_gap = 500  # ms, speech regions closer than this are merged
+vad_gates = ()  # NumPy pre-gates run before silero in this order, e.g. ("energy", "zcr", "flatness"); calibrate with gate.py first
+gate_frame_ms = 32  # Frame length the gates decide on
+gate_energy_db = -60  # dBFS, quieter frames are never speech
+gate_energy_margin_db = 6  # dB above the recording's noise floor (5th percentile frame energy) a frame must reach
+gate_zcr_min = 0.01  # Zero crossings per sample below which a frame is treated as low-frequency hum
+gate_flatness_max = 0.5  # Spectral flatness above which a frame is treated as broadband noise
+gate_pad_ms = 300  # Audio kept around gated frames before it goes to silero
+
+output_format = "both"  # "parquet": typed <session>.parquet in TRANSCRIBE_DIR, "csv": CSV only, "both": Parquet plus CSV export
+
+sentiment_batch_size = 32  # Transcriptions per BERTweet forward pass
+sentiment_backend = "torch"  # "torch": fp32 PyTorch, "quantized": int8 dynamic quantization, "onnx" / "onnx_int8": ONNX Runtime export in MODEL_CACHE_DIR
+sentiment_memo_size = 100000  # Distinct normalized utterances whose sentiment is kept in memory, with use_cache they also persist in CACHE_PATH
+
+asr_engine = "chunked"  # "chunked": one Whisper call per unit, "batched": faster-whisper batched long-form inference per recording
+asr_batch_size = 16  # Clips per forward pass for the batched engine
+word_timestamps = False  # Add per-word timings to the "words" column, costs extra alignment time in every ASR engine
+
+pipeline_mode = "staged"  # "staged": each step finishes before the next starts, "overlapped": pipeline.py runs decode, VAD, ASR and sentiment concurrently
+pipeline_queue_size = 2  # Recordings buffered between overlapped stages (bounds memory)
+
+num_workers = 1  # Transcription worker processes, each loads its own Whisper model. 1 runs in this process
+cpu_threads = 0  # Intra-op threads per worker, 0 splits os.cpu_count() evenly across the workers
+
+MANIFEST_PATH = "Cache/manifest.sqlite"  # Job manifest shared by manifest.py workers, keep it on the shared filesystem
+shared_filesystem = False  # True when Cache/ is on a network filesystem used by several hosts, SQLite files then avoid WAL mode
+lease_seconds = 300  # A claimed recording returns to the queue if its worker sends no heartbeat for this long
+max_attempts = 3  # Failed recordings are retried until they have failed this many times
+
+stream_block_ms = 32  # PCM read from the live source per block (streaming.py)
+stream_threshold = 0.5  # silero speech probability that starts an utterance
+stream_min_silence_ms = 300  # Silence that ends an utterance, lower gives results sooner but cuts more pauses
+stream_speech_pad_ms = 100  # Audio kept before and after each utterance
+
+service_host = "127.0.0.1"  # service.py only listens locally
+service_port = 8765
+watch_interval = 5  # Seconds between scans of VIDEO_PATH, a file is picked up once it is unchanged for one scan
+
+CACHE_PATH = "Cache/results.sqlite"
+use_cache = True  # Reuse VAD regions, transcripts and sentiment of unchanged audio across runs
+cache_max_bytes = 2 * 1024 ** 3  # Least recently used entries are evicted above this size
+
+INDEX_PATH = "Cache/index.sqlite"
+use_index = True  # Keep a full-text search index of every saved session up to date (index.py)
+
+trace_enabled = False  # Record per-stage and per-file timings, counters and peak memory for each main.py run
+TRACE_DIR = "Traces"
+trace_format = "chrome"  # "chrome": trace viewable in chrome://tracing or Perfetto, "jsonl": one JSON object per span
+profile_stage = None  # Name of a stage to run under cProfile in the main process, e.g. "vad" or "sentiment"; staged pipeline_mode only
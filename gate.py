@@ -0,0 +1,161 @@
+'''Cheap signal-level gates that keep obvious non-speech away from silero VAD.
+
+Audio is cut into short frames and a cascade of vectorized NumPy tests rejects frames that cannot be speech:
+  energy    quieter than the recording's noise floor plus gate_energy_margin_db (or gate_energy_db absolute)
+  zcr       almost no zero crossings, i.e. steady low-frequency hum
+  flatness  spectrally flat like hiss or wind rather than voiced
+Frames that survive every gate are padded by gate_pad_ms and only those spans are handed to silero.
+calibrate() measures how much of silero's speech the gates keep (recall) and how much audio they remove.
+
+    python gate.py Audios/*.wav
+    python gate.py --synthetic 600 --speech-density 0.2
+'''
+import sys
+import json
+import time
+import logging
+import argparse
+import numpy as np
+from config import (sample_rate, vad_gates, gate_frame_ms, gate_energy_db, gate_energy_margin_db, gate_zcr_min,
+                    gate_flatness_max, gate_pad_ms)
+from instrument import incr
+
+logging.basicConfig(level=logging.INFO)
+
+
+def frame_features(audio, sr=sample_rate, frame_ms=gate_frame_ms, block_frames=4096):
+    '''Function that returns the per-frame energy (dBFS), zero-crossing rate and spectral flatness of audio,
+    computed block by block so long recordings do not allocate one huge spectrogram'''
+    frame = int(sr * frame_ms / 1000)
+    n = len(audio) // frame
+    window = np.hanning(frame).astype(np.float32)
+    energy, zcr, flatness = np.empty(n), np.empty(n), np.empty(n)
+    for b in range(0, n, block_frames):
+        frames = np.asarray(audio[b * frame:min(b + block_frames, n) * frame], dtype=np.float32).reshape(-1, frame)
+        rows = slice(b, b + len(frames))
+        energy[rows] = 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10)
+        signs = np.signbit(frames)
+        zcr[rows] = np.mean(signs[:, 1:] != signs[:, :-1], axis=1)
+        power = np.abs(np.fft.rfft(frames * window, axis=1)) ** 2 + 1e-12
+        flatness[rows] = np.exp(np.mean(np.log(power), axis=1)) / np.mean(power, axis=1)
+    return {"frame": frame, "energy_db": energy, "zcr": zcr, "flatness": flatness}
+
+
+def _energy_gate(features):
+    if not len(features["energy_db"]):
+        return np.zeros(0, dtype=bool)
+    floor = np.percentile(features["energy_db"], 5)
+    return features["energy_db"] >= max(gate_energy_db, floor + gate_energy_margin_db)
+
+
+GATES = {
+    "energy": _energy_gate,
+    "zcr": lambda features: features["zcr"] >= gate_zcr_min,
+    "flatness": lambda features: features["flatness"] <= gate_flatness_max,
+}
+
+
+def gate_frames(audio, sr=sample_rate, gates=vad_gates, stats=None):
+    '''Function that runs the gate cascade and returns a boolean mask of the frames that may hold speech.
+    Rejections per gate are added to the tracer counters and, when given, to the stats dict'''
+    features = frame_features(audio, sr)
+    keep = np.ones(len(features["energy_db"]), dtype=bool)
+    incr("gate_frames", len(keep))
+    for name in gates:
+        rejected = keep & ~GATES[name](features)
+        keep &= ~rejected
+        incr(f"gate_rejected_{name}", int(rejected.sum()))
+        if stats is not None:
+            stats[name] = stats.get(name, 0) + int(rejected.sum())
+    return keep, features["frame"]
+
+
+def candidate_spans(audio, sr=sample_rate, gates=vad_gates, pad_ms=gate_pad_ms, stats=None):
+    '''Function that returns the (start, end) sample ranges of audio worth running silero on:
+    the frames that passed every gate, padded by pad_ms on both sides and merged'''
+    if not gates:
+        return [(0, len(audio))] if len(audio) else []
+    keep, frame = gate_frames(audio, sr, gates, stats)
+    if len(keep) * frame < len(audio):
+        # The tail shorter than a frame follows the last full frame
+        keep = np.append(keep, keep[-1] if len(keep) else True)
+    pad = -(-int(sr * pad_ms / 1000) // frame)
+    if pad and keep.any():
+        # "same" returns the kernel's length when it is longer than keep, so slice the full convolution instead
+        keep = np.convolve(keep, np.ones(2 * pad + 1), "full")[pad:pad + len(keep)] > 0
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], keep.astype(np.int8), [0]])))
+    spans = [(int(start) * frame, min(int(end) * frame, len(audio))) for start, end in edges.reshape(-1, 2)]
+    passed = sum(end - start for start, end in spans)
+    incr("gate_seconds_skipped", (len(audio) - passed) / sr)
+    return spans
+
+
+def calibrate(recordings, sr=sample_rate, gates=vad_gates or tuple(GATES)):
+    '''Function that compares silero over whole recordings with silero behind the gates.
+    recordings maps names to float32 arrays. Returns recall (share of silero's ungated speech samples that
+    gated silero also finds), the share of audio forwarded to silero, per-gate frame rejections and timings'''
+    import stt
+
+    stt.get_vad()
+    totals = {"audio_seconds": 0.0, "speech_seconds": 0.0, "found_seconds": 0.0, "forwarded_seconds": 0.0,
+              "silero_seconds": 0.0, "gated_seconds": 0.0}
+    rejected = {}
+    per_recording = {}
+    for name, audio in recordings.items():
+        started = time.perf_counter()
+        full = stt.speech_regions(audio, sr=sr, gates=())
+        silero_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        spans = candidate_spans(audio, sr, gates, stats=rejected)
+        gated = stt.speech_regions(audio, sr=sr, gates=gates)
+        gated_seconds = time.perf_counter() - started
+
+        speech = np.zeros(len(audio), dtype=bool)
+        for start, end in full:
+            speech[start:end] = True
+        found = np.zeros(len(audio), dtype=bool)
+        for start, end in gated:
+            found[start:end] = True
+        forwarded = sum(end - start for start, end in spans)
+
+        per_recording[name] = {"recall": round(float((speech & found).sum() / speech.sum()), 4) if speech.any() else None,
+                               "forwarded": round(forwarded / max(len(audio), 1), 4)}
+        totals["audio_seconds"] += len(audio) / sr
+        totals["speech_seconds"] += speech.sum() / sr
+        totals["found_seconds"] += (speech & found).sum() / sr
+        totals["forwarded_seconds"] += forwarded / sr
+        totals["silero_seconds"] += silero_seconds
+        totals["gated_seconds"] += gated_seconds
+
+    return {"gates": list(gates),
+            "recall": round(totals["found_seconds"] / totals["speech_seconds"], 4) if totals["speech_seconds"] else None,
+            "forwarded": round(totals["forwarded_seconds"] / totals["audio_seconds"], 4) if totals["audio_seconds"] else None,
+            "vad_speedup": round(totals["silero_seconds"] / totals["gated_seconds"], 2) if totals["gated_seconds"] else None,
+            "rejected_frames": rejected, "totals": {k: round(v, 3) for k, v in totals.items()},
+            "recordings": per_recording}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the recall and savings of the VAD pre-gates against silero")
+    parser.add_argument("paths", nargs="*", help="Recordings to calibrate on")
+    # Calibration is how the gates get enabled, so it tries all of them until vad_gates picks some
+    parser.add_argument("--gates", nargs="*", choices=list(GATES), default=list(vad_gates) or list(GATES))
+    parser.add_argument("--synthetic", type=float, help="Also use a synthetic recording of this many seconds")
+    parser.add_argument("--speech-density", type=float, default=0.3)
+    parser.add_argument("--min-recall", type=float, default=0.999, help="Exit with 1 below this recall")
+    args = parser.parse_args()
+
+    from utils import load_audio
+
+    recordings = {path: load_audio(path) for path in args.paths}
+    if args.synthetic:
+        from benchmark import synth_recording
+
+        recordings["synthetic"] = synth_recording(args.synthetic, args.speech_density)
+    if not recordings:
+        parser.error("give recordings to calibrate on or --synthetic")
+
+    report = calibrate(recordings, gates=args.gates)
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report["recall"] is None or report["recall"] >= args.min_recall else 1)
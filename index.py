@@ -0,0 +1,194 @@
+'''Search index over the utterances of every session.
+
+Sessions are indexed as they are saved (see store.save_session), so the index follows the results store
+without rescanning it. Text search uses SQLite FTS5 when the SQLite build has it and falls back to LIKE.
+
+    python index.py rebuild
+    python index.py search brake --sentiment NEG --start 600 --end 1200
+'''
+import os
+import glob
+import time
+import sqlite3
+import logging
+import argparse
+import functools
+import threading
+import pandas as pd
+from config import INDEX_PATH, TRANSCRIBE_DIR, use_index, shared_filesystem
+
+logging.basicConfig(level=logging.INFO)
+
+COLUMNS = ["session", "file", "start", "end", "sentiment", "transcription", "prob_neg", "prob_neu", "prob_pos"]
+
+
+class TranscriptIndex:
+    '''SQLite table of utterances with indexes on session, start time and sentiment plus an FTS5 table over
+    the transcriptions. Sessions are replaced as a whole, so re-indexing a session never duplicates rows.'''
+
+    def __init__(self, path=INDEX_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        if not shared_filesystem:
+            # WAL relies on shared memory between processes on one host, network filesystems need the rollback journal
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS utterances (
+                                 id INTEGER PRIMARY KEY,
+                                 session TEXT NOT NULL,
+                                 file TEXT,
+                                 start REAL,
+                                 "end" REAL,
+                                 sentiment TEXT,
+                                 transcription TEXT,
+                                 prob_neg REAL,
+                                 prob_neu REAL,
+                                 prob_pos REAL)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS utterances_session ON utterances (session, start)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS utterances_sentiment ON utterances (sentiment, start)")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS sessions (
+                                 session TEXT PRIMARY KEY,
+                                 rows INTEGER NOT NULL,
+                                 indexed REAL NOT NULL)""")
+        try:
+            self.conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS utterances_fts USING fts5(transcription)")
+            self.fts = True
+        except sqlite3.OperationalError:
+            logging.warning("SQLite was built without FTS5, text search falls back to LIKE")
+            self.fts = False
+        self.conn.commit()
+
+    def index_session(self, session, rows):
+        '''Replaces the indexed utterances of a session with rows (dicts or a DataFrame)'''
+        df = pd.DataFrame(rows).reindex(columns=COLUMNS[1:])
+        df = df.astype(object).where(df.notna(), None)
+        values = [(session, *row) for row in df.itertuples(index=False, name=None)]
+        with self._lock:
+            if self.fts:
+                self.conn.execute("DELETE FROM utterances_fts WHERE rowid IN (SELECT id FROM utterances WHERE session = ?)",
+                                  (session,))
+            self.conn.execute("DELETE FROM utterances WHERE session = ?", (session,))
+            cursor = self.conn.executemany(f"INSERT INTO utterances ({', '.join(map(self._quote, COLUMNS))}) "
+                                           f"VALUES ({', '.join('?' * len(COLUMNS))})", values)
+            if self.fts:
+                self.conn.execute("INSERT INTO utterances_fts (rowid, transcription) "
+                                  "SELECT id, COALESCE(transcription, '') FROM utterances WHERE session = ?", (session,))
+            self.conn.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)", (session, len(values), time.time()))
+            self.conn.commit()
+        return cursor.rowcount
+
+    def remove_session(self, session):
+        self.index_session(session, [])
+        with self._lock:
+            self.conn.execute("DELETE FROM sessions WHERE session = ?", (session,))
+            self.conn.commit()
+
+    @staticmethod
+    def _quote(column):
+        return f'"{column}"'
+
+    @staticmethod
+    def _match_terms(text):
+        '''Quotes every word of text as an FTS5 string, so punctuation and operators in it are searched
+        for literally instead of failing as query syntax'''
+        return " ".join('"' + term.replace('"', '""') + '"' for term in text.split())
+
+    def query(self, text=None, sentiment=None, start=None, end=None, sessions=None, limit=1000, raw=False):
+        '''Returns the matching utterances as a DataFrame ordered by session and start time.
+        text holds words that must all occur, or with raw an FTS5 query ("quoted phrases", prefix*, OR, NEAR),
+        and is a substring without FTS5. sentiment is a label or list of labels, start/end bound the utterance
+        start in seconds and sessions restricts the search to the given session names'''
+        where, params = [], []
+        if text:
+            if self.fts:
+                where.append("u.id IN (SELECT rowid FROM utterances_fts WHERE utterances_fts MATCH ?)")
+                params.append(text if raw else self._match_terms(text))
+            else:
+                where.append("u.transcription LIKE ?")
+                params.append(f"%{text}%")
+        for column, values in (("sentiment", sentiment), ("session", sessions)):
+            if values:
+                values = [values] if isinstance(values, str) else list(values)
+                where.append(f"u.{column} IN ({', '.join('?' * len(values))})")
+                params.extend(values)
+        if start is not None:
+            where.append("u.start >= ?")
+            params.append(start)
+        if end is not None:
+            where.append("u.start < ?")
+            params.append(end)
+
+        sql = (f"SELECT {', '.join('u.' + self._quote(c) for c in COLUMNS)} FROM utterances u"
+               f"{' WHERE ' + ' AND '.join(where) if where else ''} ORDER BY u.session, u.start LIMIT ?")
+        with self._lock:
+            rows = self.conn.execute(sql, (*params, limit)).fetchall()
+        return pd.DataFrame(rows, columns=COLUMNS)
+
+    def sessions(self):
+        '''Returns {session: utterance count} of the indexed sessions'''
+        with self._lock:
+            return dict(self.conn.execute("SELECT session, rows FROM sessions ORDER BY session").fetchall())
+
+    def rebuild(self, store_dir=TRANSCRIBE_DIR):
+        '''Indexes every session in store_dir from scratch, preferring Parquet over CSV. Returns the session count'''
+        from store import read_session
+
+        paths = {}
+        for path in sorted(glob.glob(os.path.join(store_dir, "*.csv"))) + sorted(glob.glob(os.path.join(store_dir, "*.parquet"))):
+            paths[os.path.splitext(os.path.basename(path))[0]] = path
+        for session in set(self.sessions()) - set(paths):
+            self.remove_session(session)
+        for session, path in paths.items():
+            self.index_session(session, read_session(path))
+        return len(paths)
+
+
+@functools.lru_cache(maxsize=None)
+def get_index():
+    '''Function that opens the search index on first use, or returns None when use_index is off'''
+    if not use_index:
+        return None
+    return TranscriptIndex()
+
+
+def index_session(session, rows, store_dir=TRANSCRIBE_DIR):
+    '''Function that updates the index with a session saved in store_dir, logging instead of raising so a failed
+    index update never loses the results themselves. The index holds the sessions of TRANSCRIBE_DIR by name,
+    so sessions saved anywhere else (scratch runs, benchmarks) are left out rather than replacing them'''
+    if os.path.abspath(store_dir) != os.path.abspath(TRANSCRIBE_DIR):
+        return
+    index = get_index()
+    if index is None:
+        return
+    try:
+        index.index_session(session, rows)
+    except Exception as e:
+        logging.error(f"Failed to index session {session} : {str(e)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or search the transcript index")
+    parser.add_argument("command", choices=["rebuild", "search", "sessions"])
+    parser.add_argument("text", nargs="?", help="Words to search for, all of which must occur")
+    parser.add_argument("--raw", action="store_true", help="Pass text to FTS5 as a query (phrases, prefix*, OR, NEAR)")
+    parser.add_argument("--sentiment", nargs="+", choices=["NEG", "NEU", "POS"])
+    parser.add_argument("--start", type=float, help="Earliest utterance start in seconds")
+    parser.add_argument("--end", type=float, help="Latest utterance start in seconds")
+    parser.add_argument("--session", nargs="+", dest="sessions")
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--store-dir", default=TRANSCRIBE_DIR)
+    args = parser.parse_args()
+
+    index = TranscriptIndex()
+    if args.command == "rebuild":
+        logging.info(f"Indexed {index.rebuild(args.store_dir)} sessions in {index.path}")
+    elif args.command == "sessions":
+        for session, rows in index.sessions().items():
+            print(f"{session}: {rows} utterances")
+    else:
+        started = time.perf_counter()
+        results = index.query(args.text, args.sentiment, args.start, args.end, args.sessions, args.limit, raw=args.raw)
+        with pd.option_context("display.max_colwidth", 80, "display.width", 200):
+            print(results[["session", "start", "sentiment", "transcription"]].to_string(index=False))
+        logging.info(f"{len(results)} utterances in {(time.perf_counter() - started) * 1000:.1f} ms")
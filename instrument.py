@@ -0,0 +1,168 @@
+import os
+import sys
+import json
+import time
+import pstats
+import logging
+import cProfile
+import threading
+import contextlib
+from collections import Counter
+from config import trace_enabled, TRACE_DIR, trace_format, profile_stage
+
+logging.basicConfig(level=logging.INFO)
+
+_DISABLED = contextlib.nullcontext()
+
+
+def peak_rss_mb():
+    '''Function that returns the peak resident set size of this process so far in MB, rounded to 0.1 MB.
+    The resource module only exists on Unix; elsewhere psutil is used when installed, otherwise None'''
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        memory = psutil.Process().memory_info()
+        # peak_wset is the Windows peak working set, other platforms only report the current RSS
+        return round(getattr(memory, "peak_wset", memory.rss) / 1e6, 1)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 1e6 if sys.platform == "darwin" else peak / 1e3, 1)
+
+
+class Tracer:
+    '''Collects stage and per-file timings, counters and peak memory for one pipeline run and exports
+    them as a Chrome trace (chrome://tracing, Perfetto) or as JSON lines. When disabled, span() hands back
+    a shared no-op context manager and incr() returns immediately, so instrumented code pays almost nothing.'''
+
+    def __init__(self, enabled=trace_enabled, profile=profile_stage):
+        self.enabled = enabled
+        self.profile = profile
+        self.events = []
+        self.counters = Counter()
+        self._profiler = cProfile.Profile() if enabled and profile else None
+        self._lock = threading.Lock()
+        self._t0 = time.perf_counter()
+        self._started = time.time()
+
+    def span(self, name, **args):
+        '''Returns a context manager that times the block as a stage named name, with args attached'''
+        if not self.enabled:
+            return _DISABLED
+        return self._span(name, args)
+
+    @contextlib.contextmanager
+    def _span(self, name, args):
+        profiling = self._profiler is not None and name == self.profile
+        start = time.perf_counter()
+        if profiling:
+            self._profiler.enable()
+        try:
+            yield
+        finally:
+            if profiling:
+                self._profiler.disable()
+            end = time.perf_counter()
+            args["peak_rss_mb"] = peak_rss_mb()
+            with self._lock:
+                self.events.append({"name": name, "ph": "X", "ts": (start - self._t0) * 1e6, "dur": (end - start) * 1e6,
+                                    "pid": os.getpid(), "tid": threading.get_ident(), "args": args})
+
+    def incr(self, name, n=1):
+        '''Adds n to the counter name'''
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] += n
+
+    def take(self):
+        '''Returns the spans and counters recorded so far and clears them, for a worker process to hand its
+        part of the run back to the parent with its results. Returns None when disabled'''
+        if not self.enabled:
+            return None
+        with self._lock:
+            taken = {"t0": self._t0, "events": self.events, "counters": dict(self.counters)}
+            self.events = []
+            self.counters = Counter()
+        return taken
+
+    def merge(self, taken):
+        '''Adds the spans and counters a worker returned from take(). perf_counter is system-wide, so the
+        worker's span times are only shifted from its start to ours'''
+        if not self.enabled or not taken:
+            return
+        shift = (taken["t0"] - self._t0) * 1e6
+        with self._lock:
+            self.events.extend({**event, "ts": event["ts"] + shift} for event in taken["events"])
+            self.counters.update(taken["counters"])
+
+    def summary(self):
+        '''Returns the total seconds and count per stage, the counters and the peak RSS'''
+        stages = {}
+        for event in self.events:
+            total = stages.setdefault(event["name"], {"seconds": 0.0, "count": 0})
+            total["seconds"] += event["dur"] / 1e6
+            total["count"] += 1
+        for total in stages.values():
+            total["seconds"] = round(total["seconds"], 4)
+        return {"stages": stages, "counters": dict(self.counters), "peak_rss_mb": peak_rss_mb()}
+
+    def export(self, trace_dir=TRACE_DIR, fmt=trace_format):
+        '''Writes the run to trace_dir as run-<timestamp>.json (Chrome trace) or .jsonl and returns the path.
+        The cProfile stats of the profiled stage, if any, go next to it as a .prof file'''
+        if not self.enabled:
+            return None
+        os.makedirs(trace_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self._started))
+        summary = self.summary()
+
+        if fmt == "jsonl":
+            path = os.path.join(trace_dir, f"run-{stamp}.jsonl")
+            with open(path, "w") as f:
+                for event in self.events:
+                    f.write(json.dumps({"name": event["name"], "start": event["ts"] / 1e6, "seconds": event["dur"] / 1e6,
+                                        **event["args"]}) + "\n")
+                f.write(json.dumps({"summary": summary}) + "\n")
+        else:
+            path = os.path.join(trace_dir, f"run-{stamp}.json")
+            end_ts = (time.perf_counter() - self._t0) * 1e6
+            counters = [{"name": name, "ph": "C", "ts": end_ts, "pid": os.getpid(), "args": {name: value}}
+                        for name, value in self.counters.items()]
+            with open(path, "w") as f:
+                json.dump({"traceEvents": self.events + counters, "otherData": summary}, f)
+
+        if self._profiler is not None:
+            prof_path = os.path.join(trace_dir, f"{self.profile}-{stamp}.prof")
+            self._profiler.dump_stats(prof_path)
+            pstats.Stats(prof_path).sort_stats("cumulative").print_stats(20)
+
+        logging.info(f"Trace written to {path}: {summary}")
+        return path
+
+
+tracer = Tracer()
+
+
+def span(name, **args):
+    '''Function that times a block on the run's tracer, e.g. with span("asr", file=name):'''
+    return tracer.span(name, **args)
+
+
+def incr(name, n=1):
+    '''Function that adds n to a counter on the run's tracer'''
+    tracer.incr(name, n)
+
+
+def traced_call(fn, *args):
+    '''Function that runs fn in a worker process and returns its result together with the spans and counters the
+    worker recorded, which the parent adds to its own tracer with merge_traced'''
+    return fn(*args), tracer.take()
+
+
+def merge_traced(output):
+    '''Function that unpacks the output of traced_call in the parent, merging the worker's trace. Returns the result'''
+    result, taken = output
+    tracer.merge(taken)
+    return result
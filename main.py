@@ -1,17 +1,40 @@
 from utils import video_to_audio, split_audio
-from stt import transcribe
+from stt import transcribe, transcribe_audio
+from pipeline import run_pipeline
 import logging
-from config import VIDEO_PATH, AUDIO_PATH, SEG_PATH, TRANSCRIBE_DIR
+from instrument import span, tracer
+from config import VIDEO_PATH, AUDIO_PATH, SEG_PATH, TRANSCRIBE_DIR, in_memory, save_segments, extract_wav, pipeline_mode, pcm_store
 
 logging.basicConfig(level=logging.INFO)
 
-logging.info("STEP 1: Extracting audio from video")
-video_to_audio(VIDEO_PATH, AUDIO_PATH)
+# The guard keeps spawned transcription workers (config.num_workers > 1) from re-running the pipeline
+if __name__ == "__main__":
+    with span("pipeline"):
+        if pipeline_mode == "overlapped":
+            logging.info("Running decoding, VAD, transcription and sentiment analysis as overlapped stages")
+            run_pipeline(VIDEO_PATH, TRANSCRIBE_DIR, extensions=('.mp4',))
+        elif in_memory and (pcm_store or not extract_wav):
+            # The PCM store already keeps the decoded audio, an Audios/ WAV would only decode and store it twice
+            logging.info("STEP 1: Decoding videos in memory, transcribing and performing sentiment analysis")
+            with span("transcribe_audio"):
+                transcribe_audio(VIDEO_PATH, TRANSCRIBE_DIR, SEG_PATH if save_segments else None, extensions=('.mp4',))
+        else:
+            logging.info("STEP 1: Extracting audio from video")
+            with span("video_to_audio"):
+                video_to_audio(VIDEO_PATH, AUDIO_PATH)
 
-logging.info("STEP 2: Splitting audio into segments")
-split_audio(AUDIO_PATH, SEG_PATH)
+            if in_memory:
+                logging.info("STEP 2: Transcribing audio in memory and performing sentiment analysis")
+                with span("transcribe_audio"):
+                    transcribe_audio(AUDIO_PATH, TRANSCRIBE_DIR, SEG_PATH if save_segments else None)
+            else:
+                logging.info("STEP 2: Splitting audio into segments")
+                with span("split_audio"):
+                    split_audio(AUDIO_PATH, SEG_PATH)
 
-logging.info("STEP 3: Transcribing audio and performing sentiment analysis")
-transcribe(SEG_PATH, TRANSCRIBE_DIR)
+                logging.info("STEP 3: Transcribing audio and performing sentiment analysis")
+                with span("transcribe"):
+                    transcribe(SEG_PATH, TRANSCRIBE_DIR)
 
-logging.info("Pipeline completed successfully.")
+    tracer.export()
+    logging.info("Pipeline completed successfully.")
\ No newline at end of file
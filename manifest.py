@@ -0,0 +1,259 @@
+'''Shared job manifest for processing recordings with several workers on one or more hosts.
+
+Recordings are registered in a SQLite database on the shared filesystem (MANIFEST_PATH). Each worker
+claims one recording at a time under a lease that a heartbeat thread keeps extending; a recording whose
+worker crashed or lost its lease is claimed again by another worker once the lease runs out. Completed
+stages are recorded per recording, so a retried recording skips the stages that already finished, and
+unit results already in the result cache are not transcribed again. When Cache/ sits on a network
+filesystem shared between hosts, set shared_filesystem = True so the result cache and search index use
+SQLite's rollback journal; WAL mode only works for processes on a single host.
+
+    python manifest.py add                 # register new or changed recordings in VIDEO_PATH
+    python manifest.py work                # run a worker until the queue is empty, on as many hosts as you like
+    python manifest.py status
+    python manifest.py retry               # re-queue failed recordings
+'''
+import os
+import time
+import socket
+import sqlite3
+import logging
+import argparse
+import threading
+from config import (VIDEO_PATH, AUDIO_PATH, TRANSCRIBE_DIR, MANIFEST_PATH, SEG_PATH, extract_wav, pcm_store, save_segments,
+                    lease_seconds, max_attempts)
+
+logging.basicConfig(level=logging.INFO)
+
+STAGES = ["extract", "transcribe"]
+MEDIA_EXTENSIONS = ('.mp4',)
+
+
+def worker_name():
+    '''Function that identifies this worker process across hosts'''
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class Manifest:
+    '''SQLite job table of recordings with their status, lease and completed stages. Claims run inside
+    BEGIN IMMEDIATE transactions, so two workers can never claim the same recording.'''
+
+    def __init__(self, path=MANIFEST_PATH, lease=lease_seconds, attempts=max_attempts):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.lease = lease
+        self.attempts = attempts
+        self._lock = threading.Lock()
+        # Autocommit mode, transactions are opened explicitly where several statements must be atomic
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                 path TEXT PRIMARY KEY,
+                                 mtime REAL NOT NULL,
+                                 size INTEGER NOT NULL,
+                                 status TEXT NOT NULL,
+                                 worker TEXT,
+                                 lease_expires REAL,
+                                 attempts INTEGER NOT NULL DEFAULT 0,
+                                 error TEXT,
+                                 added REAL NOT NULL,
+                                 updated REAL NOT NULL)""")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS stages (
+                                 path TEXT NOT NULL,
+                                 stage TEXT NOT NULL,
+                                 worker TEXT NOT NULL,
+                                 seconds REAL NOT NULL,
+                                 completed REAL NOT NULL,
+                                 PRIMARY KEY (path, stage))""")
+
+    def _transaction(self, fn):
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn()
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+        return result
+
+    def add(self, paths):
+        '''Registers recordings. New ones and ones whose mtime or size changed are queued with their stages
+        cleared, unchanged ones are left alone. Returns the number queued'''
+        def add():
+            queued = 0
+            now = time.time()
+            for path in paths:
+                path = os.path.abspath(path)
+                stat = os.stat(path)
+                row = self.conn.execute("SELECT mtime, size FROM jobs WHERE path = ?", (path,)).fetchone()
+                if row == (stat.st_mtime, stat.st_size):
+                    continue
+                self.conn.execute("INSERT OR REPLACE INTO jobs (path, mtime, size, status, added, updated) "
+                                  "VALUES (?, ?, ?, 'pending', ?, ?)", (path, stat.st_mtime, stat.st_size, now, now))
+                self.conn.execute("DELETE FROM stages WHERE path = ?", (path,))
+                queued += 1
+            return queued
+        return self._transaction(add)
+
+    def claim(self, worker):
+        '''Claims the oldest pending recording, or an expired lease or failed recording with attempts left.
+        Expired leases without attempts left are marked failed. Returns the path, or None when there is nothing to do'''
+        def claim():
+            now = time.time()
+            # A recording whose workers keep dying (OOM, segfault) must not crash-loop the fleet forever
+            self.conn.execute("UPDATE jobs SET status = 'failed', error = 'lease expired on every attempt', "
+                              "lease_expires = NULL, updated = ? "
+                              "WHERE status = 'running' AND lease_expires < ? AND attempts >= ?",
+                              (now, now, self.attempts))
+            row = self.conn.execute("""SELECT path FROM jobs
+                                       WHERE status = 'pending'
+                                          OR (status = 'running' AND lease_expires < ? AND attempts < ?)
+                                          OR (status = 'failed' AND attempts < ?)
+                                       ORDER BY attempts, added LIMIT 1""", (now, self.attempts, self.attempts)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE jobs SET status = 'running', worker = ?, lease_expires = ?, "
+                              "attempts = attempts + 1, updated = ? WHERE path = ?",
+                              (worker, now + self.lease, now, row[0]))
+            return row[0]
+        return self._transaction(claim)
+
+    def heartbeat(self, path, worker):
+        '''Extends the lease. Returns False when the worker no longer holds it'''
+        now = time.time()
+        with self._lock:
+            updated = self.conn.execute("UPDATE jobs SET lease_expires = ?, updated = ? "
+                                        "WHERE path = ? AND worker = ? AND status = 'running'",
+                                        (now + self.lease, now, path, worker)).rowcount
+        return updated == 1
+
+    def complete_stage(self, path, stage, worker, seconds):
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?)",
+                              (path, stage, worker, seconds, time.time()))
+
+    def completed_stages(self, path):
+        with self._lock:
+            return {stage for (stage,) in self.conn.execute("SELECT stage FROM stages WHERE path = ?", (path,))}
+
+    def finish(self, path, worker, error=None):
+        '''Marks a claimed recording done, or failed with error. Returns False when the lease was lost meanwhile'''
+        with self._lock:
+            updated = self.conn.execute("UPDATE jobs SET status = ?, error = ?, lease_expires = NULL, updated = ? "
+                                        "WHERE path = ? AND worker = ? AND status = 'running'",
+                                        ("failed" if error else "done", error, time.time(), path, worker)).rowcount
+        return updated == 1
+
+    def retry(self):
+        '''Re-queues failed recordings with a fresh attempt count. Returns the number re-queued'''
+        with self._lock:
+            return self.conn.execute("UPDATE jobs SET status = 'pending', attempts = 0, error = NULL, updated = ? "
+                                     "WHERE status = 'failed'", (time.time(),)).rowcount
+
+    def status(self):
+        '''Returns {status: count} and the rows of running and failed recordings'''
+        with self._lock:
+            counts = dict(self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            rows = self.conn.execute("SELECT path, status, worker, lease_expires, attempts, error FROM jobs "
+                                     "WHERE status IN ('running', 'failed') ORDER BY updated").fetchall()
+        return counts, rows
+
+
+def _heartbeat(manifest, path, worker, stop, lost):
+    '''Thread body that renews the lease every third of the lease time until stop is set'''
+    while not stop.wait(manifest.lease / 3):
+        if not manifest.heartbeat(path, worker):
+            logging.warning(f"Lost the lease on {path}, another worker may take it over")
+            lost.set()
+            return
+
+
+def process(manifest, path, worker, output_dir=TRANSCRIBE_DIR, pool=None):
+    '''Function that runs the stages of one claimed recording that have not completed yet'''
+    import stt
+    from utils import extract_audio
+
+    done = manifest.completed_stages(path)
+    media_path = path
+    # With the PCM store the video is decoded straight into it, an extracted WAV would be a second copy
+    if extract_wav and not pcm_store:
+        media_path = os.path.join(AUDIO_PATH, os.path.splitext(os.path.basename(path))[0] + '.wav')
+        if "extract" not in done or not os.path.exists(media_path):
+            started = time.perf_counter()
+            os.makedirs(AUDIO_PATH, exist_ok=True)
+            # extract_audio moves the WAV into place only once complete, so a crash never leaves a truncated one
+            if not extract_audio(path, media_path):
+                raise RuntimeError(f"Failed to extract audio from {path}")
+            manifest.complete_stage(path, "extract", worker, time.perf_counter() - started)
+
+    if "transcribe" not in done:
+        started = time.perf_counter()
+        # Raises when any unit failed, so the stage stays open and the recording is retried
+        stt.transcribe_recording(media_path, output_dir, pool=pool, segment_dir=SEG_PATH if save_segments else None)
+        manifest.complete_stage(path, "transcribe", worker, time.perf_counter() - started)
+
+
+def work(manifest, worker=None, output_dir=TRANSCRIBE_DIR, max_jobs=None):
+    '''Function that claims and processes recordings until none are left or max_jobs were processed.
+    Returns the number processed'''
+    import stt
+    import sentiment
+
+    worker = worker or worker_name()
+    stt.warm_up()
+    sentiment.warm_up()
+    pool = stt.worker_pool()
+    processed = 0
+    try:
+        while max_jobs is None or processed < max_jobs:
+            path = manifest.claim(worker)
+            if path is None:
+                logging.info("No recordings left to claim")
+                break
+
+            logging.info(f"{worker} claimed {path}")
+            stop, lost = threading.Event(), threading.Event()
+            beat = threading.Thread(target=_heartbeat, args=(manifest, path, worker, stop, lost), daemon=True)
+            beat.start()
+            error = None
+            try:
+                process(manifest, path, worker, output_dir, pool)
+            except Exception as e:
+                error = str(e)
+                logging.error(f"Failed to process {path} : {error}")
+            finally:
+                stop.set()
+                beat.join()
+            if not manifest.finish(path, worker, error) and not lost.is_set():
+                logging.warning(f"{path} was reclaimed by another worker before {worker} finished it")
+            processed += 1
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    return processed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared job manifest for distributed processing")
+    parser.add_argument("command", choices=["add", "work", "status", "retry"])
+    parser.add_argument("media_dir", nargs="?", default=VIDEO_PATH, help="Directory to register (add)")
+    parser.add_argument("--manifest", default=MANIFEST_PATH)
+    parser.add_argument("--worker-id", help="Defaults to <hostname>:<pid>")
+    parser.add_argument("--max-jobs", type=int, help="Stop after this many recordings (work)")
+    args = parser.parse_args()
+
+    manifest = Manifest(args.manifest)
+    if args.command == "add":
+        paths = [os.path.join(args.media_dir, f) for f in sorted(os.listdir(args.media_dir)) if f.endswith(MEDIA_EXTENSIONS)]
+        logging.info(f"Queued {manifest.add(paths)} of {len(paths)} recordings")
+    elif args.command == "work":
+        logging.info(f"Processed {work(manifest, args.worker_id, max_jobs=args.max_jobs)} recordings")
+    elif args.command == "retry":
+        logging.info(f"Re-queued {manifest.retry()} failed recordings")
+    else:
+        counts, rows = manifest.status()
+        for status in ("pending", "running", "done", "failed"):
+            print(f"{status}: {counts.get(status, 0)}")
+        for path, status, worker, lease_expires, attempts, error in rows:
+            detail = f"lease {lease_expires - time.time():.0f}s" if status == "running" else error
+            print(f"  {status} {path} ({worker}, attempt {attempts}): {detail}")
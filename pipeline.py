@@ -0,0 +1,234 @@
+import os
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from config import VIDEO_PATH, TRANSCRIBE_DIR, sample_rate, asr_engine, sentiment_batch_size, pipeline_queue_size, pcm_store
+from utils import load_audio, load_recording
+from stt import recording_units, transcribe_unit, transcribe_batched, worker_pool, recording_params, unit_key
+from sentiment import predict_sentiment
+from store import save_session
+from cache import get_cache, content_key
+from instrument import span, incr, tracer, traced_call, merge_traced
+
+logging.basicConfig(level=logging.INFO)
+
+_END = object()
+
+
+async def _decode_stage(loop, executor, paths, out_q, sr):
+    '''Decodes recordings one after another into out_q. The bounded queue stops decoding from running
+    more than pipeline_queue_size recordings ahead of VAD'''
+    cache = get_cache()
+    for path in paths:
+        name = os.path.basename(path)
+        audio_key = recording_key = cached_rows = None
+        try:
+            if cache:
+                audio_key = await loop.run_in_executor(executor, cache.file_digest, path)
+                recording_key = content_key(audio_key, recording_params())
+                cached_rows = await loop.run_in_executor(executor, cache.get, "recording", recording_key)
+            if cached_rows is None:
+                with span("decode", file=name):
+                    if pcm_store:
+                        audio = await loop.run_in_executor(executor, lambda: load_recording(path, sr=sr))
+                    else:
+                        audio = await loop.run_in_executor(executor, load_audio, path, sr)
+        except Exception as e:
+            incr("recordings_failed")
+            logging.error(f"Failed to load {name} : {str(e)}")
+            continue
+        if cached_rows is not None:
+            incr("recordings_cached")
+            logging.info(f"Using cached results for {name}")
+            await out_q.put((name, None, None, None, cached_rows))
+            continue
+        incr("recordings")
+        incr("audio_seconds", len(audio) / sr)
+        await out_q.put((name, audio, audio_key, recording_key, None))
+    await out_q.put(_END)
+
+
+async def _vad_stage(loop, executor, in_q, out_q, sr):
+    '''Finds the units of each decoded recording while the next one is still decoding'''
+    while (item := await in_q.get()) is not _END:
+        name, audio, audio_key, recording_key, cached_rows = item
+        units = None
+        if audio is not None:
+            try:
+                with span("vad", file=name):
+                    units = await loop.run_in_executor(executor, recording_units, audio, sr, audio_key)
+            except Exception as e:
+                incr("recordings_failed")
+                logging.error(f"Failed to run VAD on {name} : {str(e)}")
+                continue
+        await out_q.put((name, audio, units, recording_key, cached_rows))
+    await out_q.put(_END)
+
+
+async def _call(loop, executor, fn, *args):
+    '''Runs fn on the executor. In worker processes the spans and counters fn records come back with its result'''
+    if isinstance(executor, ProcessPoolExecutor):
+        return merge_traced(await loop.run_in_executor(executor, traced_call, fn, *args))
+    return await loop.run_in_executor(executor, fn, *args)
+
+
+async def _asr_stage(loop, executor, in_q, out_q, sr):
+    '''Transcribes the units of each recording and passes every finished unit's rows on right away, in unit order.
+    Units found in the result cache are not transcribed again, and successful ones are stored there'''
+    cache = get_cache()
+    while (item := await in_q.get()) is not _END:
+        name, audio, units, recording_key, cached_rows = item
+        if cached_rows is not None:
+            await out_q.put(("cached", name, cached_rows))
+            continue
+
+        base_name = os.path.splitext(name)[0]
+        failed = 0
+        with span("asr", file=name, units=len(units)):
+            if asr_engine == "batched":
+                # One long-form call per recording, so the recording is the only unit
+                futures = [asyncio.ensure_future(_call(loop, executor, transcribe_batched, audio, units, base_name, sr))]
+                unit_names = [name]
+                unit_keys = [None]
+            else:
+                unit_names = [f"{base_name}_{i}.wav" for i in range(len(units))]
+                jobs = [(audio[start:end], start, unit_name) for unit_name, (start, end) in zip(unit_names, units)]
+                unit_keys, cached_units = [None] * len(jobs), {}
+                if cache:
+                    # Hashing the units and reading the cache block, so they run off the event loop
+                    unit_keys = await loop.run_in_executor(None, lambda: [unit_key(*job) for job in jobs])
+                    cached_units = await loop.run_in_executor(None, cache.get_many, "unit", unit_keys)
+                futures = []
+                for i, (job, key) in enumerate(zip(jobs, unit_keys)):
+                    if key in cached_units:
+                        incr("units_cached")
+                        futures.append(loop.create_future())
+                        futures[-1].set_result(cached_units[key]["rows"])
+                        unit_keys[i] = None  # already in the cache
+                    else:
+                        futures.append(asyncio.ensure_future(_call(loop, executor, transcribe_unit, *job, sr)))
+
+            for unit_name, key, future in zip(unit_names, unit_keys, futures):
+                try:
+                    rows = await future
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    failed += 1
+                    incr("units_failed")
+                    logging.error(f"Failed to transcribe {unit_name} : {str(e)}")
+                    continue
+                # Only reached when the unit succeeded, so a failed unit is never cached
+                if cache and key:
+                    await loop.run_in_executor(None, cache.put, "unit", key, {"rows": rows})
+                if rows is None:
+                    incr("units_skipped")
+                    continue
+                incr("units_processed")
+                await out_q.put(("rows", name, rows))
+
+        # A recording with failed units must not be cached, or the next run would never retry them
+        await out_q.put(("end", name, None if failed else recording_key))
+    await out_q.put(_END)
+
+
+async def _sentiment_stage(loop, executor, in_q, output_dir, stats):
+    '''Scores utterances in batches as they arrive and saves each recording once all its units are through'''
+    cache = get_cache()
+    sessions = {}
+    batch = []
+
+    async def flush():
+        if not batch:
+            return
+        texts = [row["transcription"] for row in batch]
+        with span("sentiment", rows=len(texts)):
+            labels, probs = await loop.run_in_executor(executor, lambda: predict_sentiment(texts, return_probs=True))
+        for row, label, prob in zip(batch, labels, probs):
+            row["sentiment"] = label
+            row.update({f"prob_{key.lower()}": value for key, value in prob.items()})
+        batch.clear()
+
+    async def finish(name, rows, recording_key=None):
+        # Writing the session and the cache entry blocks on disk, so it runs on the executor, off the event loop
+        with span("write", file=name):
+            await loop.run_in_executor(executor, save_session, rows, os.path.splitext(name)[0], output_dir)
+        if cache and recording_key:
+            await loop.run_in_executor(executor, cache.put, "recording", recording_key, rows)
+        if stats["first_result"] is None:
+            stats["first_result"] = time.perf_counter() - stats["started"]
+
+    while (item := await in_q.get()) is not _END:
+        kind, name, payload = item
+        if kind == "cached":
+            await finish(name, payload)
+        elif kind == "rows":
+            sessions.setdefault(name, []).extend(payload)
+            batch.extend(payload)
+            # Score full batches, or whatever is waiting when ASR has nothing new for us
+            if len(batch) >= sentiment_batch_size or in_q.empty():
+                await flush()
+        else:
+            await flush()
+            await finish(name, sessions.pop(name, []), payload)
+
+
+async def _run_pipeline(paths, output_dir, sr):
+    loop = asyncio.get_running_loop()
+    decoded_q = asyncio.Queue(maxsize=pipeline_queue_size)
+    units_q = asyncio.Queue(maxsize=pipeline_queue_size)
+    rows_q = asyncio.Queue(maxsize=pipeline_queue_size * sentiment_batch_size)
+    stats = {"started": time.perf_counter(), "first_result": None}
+
+    decode_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="decode")
+    vad_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vad")
+    asr_executor = worker_pool() or ThreadPoolExecutor(max_workers=1, thread_name_prefix="asr")
+    sentiment_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sentiment")
+    executors = [decode_executor, vad_executor, asr_executor, sentiment_executor]
+
+    tasks = [
+        asyncio.create_task(_decode_stage(loop, decode_executor, paths, decoded_q, sr)),
+        asyncio.create_task(_vad_stage(loop, vad_executor, decoded_q, units_q, sr)),
+        asyncio.create_task(_asr_stage(loop, asr_executor, units_q, rows_q, sr)),
+        asyncio.create_task(_sentiment_stage(loop, sentiment_executor, rows_q, output_dir, stats)),
+    ]
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        failed = [task for task in done if task.exception() is not None]
+        if failed:
+            # Stop the other stages and drop queued executor work before surfacing the error
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            raise failed[0].exception()
+    finally:
+        for executor in executors:
+            executor.shutdown(cancel_futures=True)
+
+    makespan = time.perf_counter() - stats["started"]
+    logging.info(f"Pipeline finished {len(paths)} recordings in {makespan:.1f}s, first result after "
+                 f"{stats['first_result'] or 0:.1f}s")
+    return stats
+
+
+def run_pipeline(media_dir=VIDEO_PATH, output_dir=TRANSCRIBE_DIR, extensions=('.mp4',), sr=sample_rate):
+    '''Function that runs decoding, VAD, ASR and sentiment as overlapping stages connected by bounded queues.
+    While recording N is in VAD or ASR, recording N+1 is decoding, and sentiment scores utterances as soon
+    as their unit is transcribed. An error in any stage cancels the others and is raised here.'''
+    if not os.path.exists(media_dir):
+        logging.error("Directory does not exist")
+        return
+
+    paths = [os.path.join(media_dir, f) for f in sorted(os.listdir(media_dir)) if f.endswith(tuple(extensions))]
+    if not paths:
+        logging.error("No recordings found")
+        return
+
+    if tracer.profile:
+        # cProfile only follows the thread that enables it, the event loop here, while every stage runs on executors
+        raise ValueError(f"profile_stage = {tracer.profile!r} is not supported with pipeline_mode = \"overlapped\", "
+                         "profile the stage in staged mode")
+
+    logging.info(f"Found {len(paths)} recordings")
+    return asyncio.run(_run_pipeline(paths, output_dir, sr))
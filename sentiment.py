@@ -1,27 +1,283 @@
-from pysentimiento import create_analyzer
-import transformers
+import os
+import re
+import sys
+import time
+import logging
+import argparse
+import functools
+import threading
+import unicodedata
+from collections import OrderedDict, Counter
+import numpy as np
 import pandas as pd
+from config import sentiment_batch_size, sentiment_model, sentiment_memo_size, sentiment_backend, MODEL_CACHE_DIR, TRANSCRIBE_DIR
+from cache import get_cache, content_key
+from instrument import span, incr
 
-transformers.logging.set_verbosity(transformers.logging.ERROR)
+_memo = OrderedDict()
+_memo_lock = threading.Lock()
+_memo_counts = Counter()
 
-analyzer = create_analyzer(task="sentiment", lang="en")
+
+def _model_path(repo_id):
+    '''Function that returns the local snapshot of a Hugging Face model under MODEL_CACHE_DIR,
+    downloading it only when it is not cached yet'''
+    from huggingface_hub import snapshot_download
+
+    cache_dir = os.path.join(MODEL_CACHE_DIR, "huggingface")
+    try:
+        return snapshot_download(repo_id, cache_dir=cache_dir, local_files_only=True)
+    except Exception:
+        logging.info(f"Sentiment model {repo_id} not cached, downloading to {MODEL_CACHE_DIR}")
+        return snapshot_download(repo_id, cache_dir=cache_dir)
+
+
+@functools.lru_cache(maxsize=None)
+def get_analyzer():
+    '''Function that builds the pysentimiento analyzer on first use from the locally cached model'''
+    import transformers
+    from pysentimiento import create_analyzer
+
+    transformers.logging.set_verbosity(transformers.logging.ERROR)
+    with span("model_load", model="sentiment"):
+        return create_analyzer(task="sentiment", lang="en", model_name=_model_path(sentiment_model))
+
+
+@functools.lru_cache(maxsize=None)
+def model_version(backend=sentiment_backend):
+    '''Function that identifies the sentiment model by name, snapshot revision and backend, part of every memo key'''
+    return {"model": sentiment_model, "revision": os.path.basename(_model_path(sentiment_model)), "backend": backend}
+
+
+def _onnx_path(backend):
+    '''Function that exports the sentiment model to ONNX under MODEL_CACHE_DIR on first use, quantized to int8
+    for the onnx_int8 backend, and returns the file path'''
+    import torch
+
+    onnx_dir = os.path.join(MODEL_CACHE_DIR, "onnx")
+    revision = model_version()["revision"]
+    path = os.path.join(onnx_dir, f"{revision}.onnx")
+    if not os.path.exists(path):
+        logging.info(f"Exporting {sentiment_model} to {path}")
+        os.makedirs(onnx_dir, exist_ok=True)
+        analyzer = get_analyzer()
+        dummy = analyzer.tokenizer(["okay"], return_tensors="pt")
+        names = list(dummy.keys())
+        torch.onnx.export(analyzer.model, tuple(dummy[name] for name in names), path + ".tmp", input_names=names,
+                          output_names=["logits"], opset_version=14,
+                          dynamic_axes={**{name: {0: "batch", 1: "sequence"} for name in names}, "logits": {0: "batch"}})
+        os.replace(path + ".tmp", path)
+
+    if backend != "onnx_int8":
+        return path
+    int8_path = os.path.join(onnx_dir, f"{revision}.int8.onnx")
+    if not os.path.exists(int8_path):
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        logging.info(f"Quantizing {path} to {int8_path}")
+        quantize_dynamic(path, int8_path + ".tmp", weight_type=QuantType.QInt8)
+        os.replace(int8_path + ".tmp", int8_path)
+    return int8_path
+
+
+@functools.lru_cache(maxsize=None)
+def get_backend(backend=sentiment_backend):
+    '''Function that prepares the sentiment model for a backend on first use and returns a function mapping
+    a dict of tokenized NumPy arrays to NumPy logits.
+    "torch": the fp32 PyTorch model, "quantized": PyTorch with int8 dynamically quantized Linear layers,
+    "onnx" / "onnx_int8": an ONNX export of the model (fp32 or int8 weights) run by ONNX Runtime'''
+    import torch
+
+    analyzer = get_analyzer()
+    with span("model_load", model=f"sentiment_{backend}"):
+        if backend in ("torch", "quantized"):
+            model = analyzer.model.eval()
+            if backend == "quantized":
+                # Copy first so the fp32 model stays available for check_agreement
+                import copy
+
+                model = torch.quantization.quantize_dynamic(copy.deepcopy(model), {torch.nn.Linear}, dtype=torch.qint8)
+
+            def run(inputs):
+                with torch.no_grad():
+                    inputs = {name: torch.from_numpy(value).to(model.device) for name, value in inputs.items()}
+                    return model(**inputs).logits.cpu().numpy()
+            return run
+
+        if backend in ("onnx", "onnx_int8"):
+            import onnxruntime
+
+            session = onnxruntime.InferenceSession(_onnx_path(backend), providers=["CPUExecutionProvider"])
+            names = [node.name for node in session.get_inputs()]
+
+            def run(inputs):
+                return session.run(["logits"], {name: inputs[name] for name in names})[0]
+            return run
+
+    raise ValueError(f"Unknown sentiment backend {backend!r}, expected torch, quantized, onnx or onnx_int8")
+
+
+def warm_up():
+    '''Function that loads the sentiment model and prepares the configured backend ahead of the first prediction'''
+    get_backend(sentiment_backend)
+
+
+def _predict_batch(texts, backend=sentiment_backend):
+    '''Function that runs a single padded forward pass over a batch of texts and returns their labels
+    and {label: probability} dicts'''
+    from pysentimiento.preprocessing import preprocess_tweet
+
+    analyzer = get_analyzer()
+    texts = [preprocess_tweet(text, lang="en") for text in texts]
+    inputs = analyzer.tokenizer(texts, padding=True, truncation=True, max_length=128, return_tensors="np")
+    logits = get_backend(backend)({name: value.astype(np.int64) for name, value in inputs.items()})
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    probs = np.exp(logits) / np.exp(logits).sum(axis=-1, keepdims=True)
+    id2label = analyzer.model.config.id2label
+    labels = [id2label[i] for i in probs.argmax(axis=-1).tolist()]
+    return labels, [{id2label[j]: p for j, p in enumerate(row)} for row in probs.tolist()]
+
+
+def normalize_text(text):
+    '''Function that normalizes an utterance for memoization: NFKC and single spaces. Case is kept, the
+    model scores "NO" and "no" differently'''
+    if pd.isna(text):
+        return ""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", str(text))).strip()
+
+
+def _memo_lookup(keys):
+    '''Function that returns {key: (label, probs)} for the keys found in memory or, failing that, on disk'''
+    found = {}
+    with _memo_lock:
+        for key in keys:
+            if key in _memo:
+                _memo.move_to_end(key)
+                found[key] = _memo[key]
+    memory_hits = len(found)
+
+    cache = get_cache()
+    missing = [key for key in keys if key not in found]
+    if cache and missing:
+        stored = {key: (value["label"], value["probs"]) for key, value in cache.get_many("sentiment", missing).items()}
+        _memo_store(stored)
+        found.update(stored)
+
+    _memo_counts["memory_hits"] += memory_hits
+    _memo_counts["disk_hits"] += len(found) - memory_hits
+    incr("sentiment_memory_hits", memory_hits)
+    incr("sentiment_disk_hits", len(found) - memory_hits)
+    return found
+
+
+def _memo_store(results, persist=False):
+    '''Function that adds {key: (label, probs)} to the in-memory LRU and, with persist, to the result cache'''
+    with _memo_lock:
+        for key, value in results.items():
+            _memo[key] = value
+            _memo.move_to_end(key)
+        while len(_memo) > sentiment_memo_size:
+            _memo.popitem(last=False)
+    cache = get_cache()
+    if persist and cache and results:
+        cache.put_many("sentiment", {key: {"label": label, "probs": probs} for key, (label, probs) in results.items()})
+
+
+def memo_stats():
+    '''Function that returns the memo hits, misses and hit rate of this process so far'''
+    stats = {name: _memo_counts[name] for name in ("memory_hits", "disk_hits", "misses")}
+    total = sum(stats.values())
+    stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / total, 4) if total else None
+    stats["memory_entries"] = len(_memo)
+    return stats
+
+
+def predict_sentiment(texts, batch_size=sentiment_batch_size, return_probs=False):
+    '''Function that predicts sentiment labels for a list of texts in batches.
+    Texts are normalized (see normalize_text) and each distinct text is looked up in the memo, in memory
+    and then in the result cache, keyed by the text and the model version. Only the misses run through
+    the model, sorted by length so each batch pads to a similar length.
+    With return_probs the {label: probability} dict of every text is returned as well.'''
+    texts = [normalize_text(text) for text in texts]
+    version = model_version()
+    keys = {text: content_key(text, version) for text in set(texts)}
+    results = _memo_lookup(list(keys.values()))
+
+    misses = sorted((text for text, key in keys.items() if key not in results), key=len)
+    _memo_counts["misses"] += len(misses)
+    incr("sentiment_misses", len(misses))
+    for b in range(0, len(misses), batch_size):
+        batch = misses[b:b + batch_size]
+        batch_labels, batch_probs = _predict_batch(batch)
+        computed = {keys[text]: (label, prob) for text, label, prob in zip(batch, batch_labels, batch_probs)}
+        _memo_store(computed, persist=True)
+        results.update(computed)
+
+    if texts:
+        logging.info(f"Sentiment for {len(texts)} texts: {len(keys)} distinct, {len(misses)} run through the model")
+    labels = [results[keys[text]][0] for text in texts]
+    if return_probs:
+        return labels, [results[keys[text]][1] for text in texts]
+    return labels
 
 
 def get_sentiment(input_csv, output_csv):
     '''Function that predicts sentiment for a transcription file'''
     try:
         data = pd.read_csv(input_csv)
-        if "sentiment" not in data.columns:
-            data["sentiment"] = ""
-
-        for i in range(len(data)):
-            row = data.iloc[i]
-            text = row["transcription"]
-            sentiment = analyzer.predict(text)
-            data.at[i, "sentiment"] = sentiment.output
+        data["sentiment"] = predict_sentiment(data["transcription"].tolist())
 
         data.to_csv(output_csv, index=False)
         print(f"Sentiment analysis saved to {output_csv}")
 
+        from index import index_session
+        index_session(os.path.splitext(os.path.basename(output_csv))[0], data, os.path.dirname(os.path.abspath(output_csv)))
+
     except Exception as e:
         print(f"Error processing {input_csv}: {str(e)}")
+
+
+def check_agreement(texts, backend=sentiment_backend, batch_size=sentiment_batch_size):
+    '''Function that scores texts with the fp32 torch backend and with backend, bypassing the memo, and returns
+    the label agreement, the largest probability difference and the texts per second of both'''
+    texts = sorted((normalize_text(text) for text in texts), key=len)
+    outputs = {}
+    for name in ("torch", backend):
+        get_backend(name)
+        started = time.perf_counter()
+        labels, probs = [], []
+        for b in range(0, len(texts), batch_size):
+            batch_labels, batch_probs = _predict_batch(texts[b:b + batch_size], backend=name)
+            labels.extend(batch_labels)
+            probs.extend(batch_probs)
+        outputs[name] = (labels, probs, time.perf_counter() - started)
+
+    ref_labels, ref_probs, ref_seconds = outputs["torch"]
+    labels, probs, seconds = outputs[backend]
+    agreement = round(float(np.mean([a == b for a, b in zip(ref_labels, labels)])), 4) if texts else None
+    max_diff = max((abs(a[k] - b[k]) for a, b in zip(ref_probs, probs) for k in a), default=None)
+    return {"backend": backend, "texts": len(texts), "agreement": agreement, "max_prob_diff": max_diff,
+            "torch_texts_per_second": round(len(texts) / ref_seconds, 1) if ref_seconds else None,
+            "backend_texts_per_second": round(len(texts) / seconds, 1) if seconds else None,
+            "disagreements": [(text, a, b) for text, a, b in zip(texts, ref_labels, labels) if a != b][:20]}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check a sentiment backend against the fp32 torch model")
+    parser.add_argument("--backend", default=sentiment_backend, choices=["torch", "quantized", "onnx", "onnx_int8"])
+    parser.add_argument("--store-dir", default=TRANSCRIBE_DIR, help="Validation texts are sampled from these sessions")
+    parser.add_argument("--sample", type=int, default=500, help="Number of distinct transcriptions to compare")
+    parser.add_argument("--min-agreement", type=float, default=0.97, help="Exit with 1 below this label agreement")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    from store import read_dataset
+
+    texts = read_dataset(args.store_dir, columns=["transcription"])["transcription"].dropna().drop_duplicates()
+    if texts.empty:
+        logging.error(f"No transcriptions found in {args.store_dir}")
+        sys.exit(1)
+    report = check_agreement(texts.sample(min(args.sample, len(texts)), random_state=args.seed).tolist(), args.backend)
+    for key, value in report.items():
+        print(f"{key}: {value}")
+    sys.exit(0 if report["agreement"] >= args.min_agreement else 1)
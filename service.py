@@ -0,0 +1,256 @@
+'''Long-running ingestion service that keeps Whisper, silero VAD and the sentiment model loaded.
+
+New or changed recordings in VIDEO_PATH are picked up once they stop growing and are transcribed one at
+a time into TRANSCRIBE_DIR, so each recording only costs inference time. A small HTTP API on
+service_host:service_port submits files and reports job status and results:
+
+    python service.py
+    python service.py --port 9000 --no-watch
+
+    curl -X POST localhost:8765/jobs -d '{"path": "Videos/drive.mp4"}'
+    curl localhost:8765/jobs
+    curl localhost:8765/jobs/1
+    curl "localhost:8765/results/drive?columns=start,transcription,sentiment"
+    curl localhost:8765/health
+'''
+import os
+import json
+import time
+import queue
+import logging
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import stt
+import sentiment
+from config import VIDEO_PATH, TRANSCRIBE_DIR, output_format, service_host, service_port, watch_interval
+from store import session_path, read_session
+from instrument import incr
+
+logging.basicConfig(level=logging.INFO)
+
+MEDIA_EXTENSIONS = ('.mp4',)
+
+
+def _signature(path):
+    '''Function that returns the (mtime, size) of a file, used to notice new and changed recordings'''
+    stat = os.stat(path)
+    return stat.st_mtime, stat.st_size
+
+
+def _result_path(session, output_dir=TRANSCRIBE_DIR):
+    '''Function that returns the saved file of a session, preferring Parquet, or None when there is none'''
+    for ext in (".parquet", ".csv"):
+        path = session_path(session, output_dir, ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+class Service:
+    '''Owns the warm models, the job registry, the folder watcher and the single transcription worker.
+    Jobs run one at a time in submission order; with num_workers > 1 each job's units still spread over
+    the worker pool, which is started once and kept for the lifetime of the service.'''
+
+    def __init__(self, media_dir=VIDEO_PATH, output_dir=TRANSCRIBE_DIR, interval=watch_interval):
+        self.media_dir = media_dir
+        self.output_dir = output_dir
+        self.interval = interval
+        self.jobs = {}
+        self.queue = queue.Queue()
+        self.pool = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._next_id = 1
+        self._seen = {}
+        self._threads = []
+
+    def start(self, watch=True):
+        '''Loads the models and starts the worker and, with watch, the folder watcher'''
+        started = time.perf_counter()
+        stt.warm_up()
+        sentiment.warm_up()
+        self.pool = stt.worker_pool()
+        logging.info(f"Models loaded in {time.perf_counter() - started:.1f}s")
+
+        self._threads.append(threading.Thread(target=self._work, name="worker", daemon=True))
+        if watch:
+            self._threads.append(threading.Thread(target=self._watch, name="watcher", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        '''Stops the threads after the running job and shuts the worker pool down'''
+        self._stop.set()
+        self.queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout=self.interval + 1)
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+
+    def submit(self, path):
+        '''Queues a recording unless it is already queued or running. Returns its job dict'''
+        path = os.path.abspath(path)
+        with self._lock:
+            for job in self.jobs.values():
+                if job["path"] == path and job["status"] in ("queued", "running"):
+                    return dict(job)
+            job = {"id": self._next_id, "path": path, "session": os.path.splitext(os.path.basename(path))[0],
+                   "status": "queued", "submitted": time.time(), "started": None, "finished": None,
+                   "seconds": None, "rows": None, "error": None}
+            self.jobs[job["id"]] = job
+            self._next_id += 1
+        self.queue.put(job["id"])
+        logging.info(f"Queued job {job['id']} for {path}")
+        return dict(job)
+
+    def get_job(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def list_jobs(self):
+        with self._lock:
+            return [dict(job) for job in self.jobs.values()]
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            self.jobs[job_id].update(fields)
+
+    def _work(self):
+        '''Runs queued jobs one after another with the already loaded models'''
+        while (job_id := self.queue.get()) is not None:
+            job = self.get_job(job_id)
+            started = time.perf_counter()
+            self._update(job_id, status="running", started=time.time())
+            try:
+                rows = stt.transcribe_recording(job["path"], self.output_dir, pool=self.pool)
+            except Exception as e:
+                incr("jobs_failed")
+                logging.error(f"Job {job_id} for {job['path']} failed : {str(e)}")
+                self._update(job_id, status="failed", finished=time.time(), error=str(e),
+                             seconds=round(time.perf_counter() - started, 3))
+                continue
+            incr("jobs_done")
+            seconds = round(time.perf_counter() - started, 3)
+            logging.info(f"Job {job_id} for {job['path']} finished in {seconds}s")
+            self._update(job_id, status="done", finished=time.time(), rows=len(rows), seconds=seconds)
+
+    def _up_to_date(self, path):
+        '''Returns True when the recording's session file is newer than the recording itself'''
+        result = _result_path(os.path.splitext(os.path.basename(path))[0], self.output_dir)
+        return result is not None and os.path.getmtime(result) >= os.path.getmtime(path)
+
+    def _scan(self, first=False):
+        '''Queues recordings whose (mtime, size) is unchanged since the previous scan and differs from the
+        last processed version. On the first scan, recordings with an up-to-date session are skipped'''
+        if not os.path.isdir(self.media_dir):
+            return
+        for name in sorted(os.listdir(self.media_dir)):
+            path = os.path.abspath(os.path.join(self.media_dir, name))
+            if not name.endswith(MEDIA_EXTENSIONS):
+                continue
+            try:
+                signature = _signature(path)
+            except OSError:
+                continue
+            previous, processed = self._seen.get(path, (None, None))
+            if first and self._up_to_date(path):
+                self._seen[path] = (signature, signature)
+            elif signature == previous and signature != processed:
+                # Still the same size and mtime one scan later, so the copy into the folder has finished
+                self.submit(path)
+                self._seen[path] = (signature, signature)
+            else:
+                self._seen[path] = (signature, processed)
+
+    def _watch(self):
+        first = True
+        while not self._stop.is_set():
+            try:
+                self._scan(first)
+            except Exception as e:
+                logging.error(f"Failed to scan {self.media_dir} : {str(e)}")
+            first = False
+            self._stop.wait(self.interval)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    '''JSON API of the service, see the module docstring for the routes'''
+
+    def _send(self, status, body):
+        data = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        service = self.server.service
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split("/") if part]
+
+        if parts == ["health"]:
+            return self._send(200, {"status": "ok", "queued": service.queue.qsize(), "sentiment_memo": sentiment.memo_stats()})
+        if parts == ["jobs"]:
+            return self._send(200, service.list_jobs())
+        if len(parts) == 2 and parts[0] == "jobs":
+            job = service.get_job(int(parts[1])) if parts[1].isdigit() else None
+            return self._send(200, job) if job else self._send(404, {"error": "unknown job"})
+        if len(parts) == 2 and parts[0] == "results":
+            path = _result_path(parts[1], service.output_dir)
+            if path is None:
+                return self._send(404, {"error": "unknown session"})
+            columns = parse_qs(url.query).get("columns")
+            columns = columns[0].split(",") if columns else None
+            try:
+                df = read_session(path, columns)
+            except Exception as e:
+                return self._send(400, {"error": str(e)})
+            # to_json turns missing values into null, which json.dumps would write as NaN
+            return self._send(200, df.to_json(orient="records"))
+        self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        if urlparse(self.path).path.rstrip("/") != "/jobs":
+            return self._send(404, {"error": "not found"})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            path = json.loads(self.rfile.read(length) or b"{}")["path"]
+        except (ValueError, KeyError, TypeError):
+            return self._send(400, {"error": 'expected a JSON body like {"path": "Videos/drive.mp4"}'})
+        if not os.path.isfile(path):
+            return self._send(404, {"error": f"no such file: {path}"})
+        self._send(202, self.server.service.submit(path))
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+
+def serve(host=service_host, port=service_port, watch=True):
+    '''Function that starts the service and answers API requests until interrupted'''
+    service = Service()
+    service.start(watch=watch)
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.service = service
+    logging.info(f"Serving on http://{host}:{port}, watching {service.media_dir if watch else 'nothing'}, "
+                 f"results in {service.output_dir} ({output_format})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep the models loaded and transcribe recordings as they arrive")
+    parser.add_argument("--host", default=service_host)
+    parser.add_argument("--port", type=int, default=service_port)
+    parser.add_argument("--no-watch", action="store_true", help=f"Only process files submitted through the API, do not watch {VIDEO_PATH}")
+    args = parser.parse_args()
+    serve(args.host, args.port, watch=not args.no_watch)
@@ -0,0 +1,96 @@
+import os
+import glob
+import json
+import logging
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+from config import (TRANSCRIBE_DIR, output_format, model_name, compute_type, asr_engine, segmentation, sentiment_model,
+                    sentiment_backend)
+
+logging.basicConfig(level=logging.INFO)
+
+SCHEMA = pa.schema([
+    ("session", pa.string()),
+    ("file", pa.string()),
+    ("start", pa.float64()),
+    ("end", pa.float64()),
+    ("transcription", pa.string()),
+    ("words", pa.string()),
+    ("sentiment", pa.string()),
+    ("prob_neg", pa.float64()),
+    ("prob_neu", pa.float64()),
+    ("prob_pos", pa.float64()),
+])
+OUTPUT_COLUMNS = [name for name in SCHEMA.names if name != "session"]
+
+
+def model_metadata():
+    '''Function that returns the model settings stored with every session'''
+    return {"model_name": model_name, "compute_type": compute_type, "asr_engine": asr_engine,
+            "segmentation": segmentation, "sentiment_model": sentiment_model, "sentiment_backend": sentiment_backend}
+
+
+def session_path(session, store_dir=TRANSCRIBE_DIR, ext=".parquet"):
+    return os.path.join(store_dir, f"{session}{ext}")
+
+
+def write_session(rows, session, store_dir=TRANSCRIBE_DIR, metadata=None):
+    '''Function that writes one session's rows to <store_dir>/<session>.parquet with typed columns and
+    the model metadata in the file schema. Returns the file path'''
+    df = pd.DataFrame(rows).reindex(columns=OUTPUT_COLUMNS)
+    df.insert(0, "session", session)
+    table = pa.Table.from_pandas(df, schema=SCHEMA, preserve_index=False)
+    table = table.replace_schema_metadata({"commsim": json.dumps(metadata or model_metadata())})
+
+    os.makedirs(store_dir, exist_ok=True)
+    path = session_path(session, store_dir)
+    pq.write_table(table, path + ".tmp")
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def save_session(rows, session, store_dir=TRANSCRIBE_DIR, fmt=output_format):
+    '''Function that saves a session as Parquet, CSV or both according to fmt'''
+    if fmt in ("parquet", "both"):
+        logging.info(f"Transcription and sentiment saved to {write_session(rows, session, store_dir)}")
+    if fmt in ("csv", "both"):
+        os.makedirs(store_dir, exist_ok=True)
+        csv_path = session_path(session, store_dir, ".csv")
+        pd.DataFrame(rows).reindex(columns=OUTPUT_COLUMNS).to_csv(csv_path + ".tmp", index=False)
+        os.replace(csv_path + ".tmp", csv_path)
+        logging.info(f"Transcription and sentiment saved to {csv_path}")
+
+    from index import index_session
+    from visualization import save_session_pyramid
+    index_session(session, rows, store_dir)
+    save_session_pyramid(rows, session, store_dir)
+
+
+def read_session(path, columns=None):
+    '''Function that reads a session file, only the given columns, memory-mapping Parquet files'''
+    if path.endswith(".csv"):
+        return pd.read_csv(path, usecols=(lambda c: c in columns) if columns else None)
+    return pq.read_table(path, columns=columns, memory_map=True).to_pandas()
+
+
+def read_metadata(path):
+    '''Function that returns the model metadata stored with a Parquet session'''
+    metadata = pq.read_schema(path, memory_map=True).metadata or {}
+    return json.loads(metadata.get(b"commsim", b"{}"))
+
+
+def read_dataset(store_dir=TRANSCRIBE_DIR, columns=None, filter=None):
+    '''Function that reads every Parquet session in store_dir as one table. Only the given columns are
+    loaded and filter, a pyarrow.dataset expression, is pushed down to the files'''
+    paths = sorted(glob.glob(os.path.join(store_dir, "*.parquet")))
+    dataset = ds.dataset(paths, format="parquet", schema=SCHEMA)
+    return dataset.to_table(columns=columns, filter=filter).to_pandas()
+
+
+def export_csv(path, csv_path=None):
+    '''Function that exports a Parquet session to CSV next to it, or to csv_path'''
+    csv_path = csv_path or os.path.splitext(path)[0] + ".csv"
+    read_session(path).drop(columns="session").to_csv(csv_path, index=False)
+    return csv_path
@@ -0,0 +1,230 @@
+'''Live transcription of a PCM stream with utterance-level results.
+
+Audio arrives as 16-bit mono PCM at sample_rate from stdin, a FIFO, or a recording replayed in real time
+(the local stand-in for the simulator microphone). silero's VADIterator follows the stream window by window;
+when an utterance ends (stream_min_silence_ms of silence) it is transcribed and scored on a worker thread and
+its rows are handed to a callback, by default printed as JSON lines. End-to-end latency, from the end of
+speech to the delivered row, is reported as percentiles at the end.
+
+    python streaming.py Audios/session.wav                  # replay in real time
+    arecord -f S16_LE -r 16000 -c 1 -t raw | python streaming.py -
+    python streaming.py /tmp/sim_audio.fifo --session live_01
+'''
+import os
+import sys
+import json
+import stat
+import time
+import wave
+import queue
+import logging
+import argparse
+import threading
+import numpy as np
+from config import (sample_rate, word_timestamps, max_region_length, stream_block_ms, stream_threshold,
+                    stream_min_silence_ms, stream_speech_pad_ms, TRANSCRIBE_DIR)
+from utils import stream_pcm
+from instrument import span, incr
+
+logging.basicConfig(level=logging.INFO)
+
+VAD_WINDOW = 512  # Samples per silero call at 16 kHz
+
+
+def pcm_source(source, sr=sample_rate, block_ms=stream_block_ms, realtime=None):
+    '''Generator that yields (float32 block, arrival time) pairs from "-" (stdin), a FIFO or a file.
+    Files are paced to real time unless realtime is False; stdin and FIFOs arrive at their own pace'''
+    block = int(sr * block_ms / 1000)
+    if source == "-" or stat.S_ISFIFO(os.stat(source).st_mode):
+        f = sys.stdin.buffer if source == "-" else open(source, "rb")
+        carry = b""
+        try:
+            while data := f.read(block * 2):
+                data = carry + data
+                carry = data[len(data) - len(data) % 2:]
+                yield np.frombuffer(data[:len(data) - len(carry)], dtype=np.int16).astype(np.float32) / 32768.0, time.perf_counter()
+        finally:
+            if f is not sys.stdin.buffer:
+                f.close()
+        return
+
+    blocks = _file_blocks(source, sr, block)
+    started = time.perf_counter()
+    position = 0
+    for pcm in blocks:
+        position += len(pcm)
+        if realtime is not False:
+            # The block is "recorded" only once its last sample would have been spoken
+            time.sleep(max(0.0, started + position / sr - time.perf_counter()))
+        yield pcm.astype(np.float32) / 32768.0, time.perf_counter()
+
+
+def _file_blocks(path, sr, block):
+    '''Reads int16 blocks from a WAV that already matches sr (mono, 16-bit) and from anything else through ffmpeg'''
+    if path.endswith(".wav"):
+        with wave.open(path, "rb") as wf:
+            if (wf.getnchannels(), wf.getsampwidth(), wf.getframerate()) == (1, 2, sr):
+                while data := wf.readframes(block):
+                    yield np.frombuffer(data, dtype=np.int16)
+                return
+    yield from stream_pcm(path, sr=sr, block_seconds=block / sr)
+
+
+def print_rows(rows):
+    '''Default callback, writes each finished row to stdout as a JSON line'''
+    for row in rows:
+        print(json.dumps(row), flush=True)
+
+
+class StreamTranscriber:
+    '''Feeds audio blocks through silero's VADIterator, cuts utterances at end of speech (or at
+    max_region_length) and transcribes them on a worker thread so VAD keeps up with the stream.
+    Rows carry the stream time in seconds in start/end and their end-to-end latency in latency.'''
+
+    def __init__(self, callback=print_rows, sr=sample_rate, session="stream"):
+        import stt
+
+        self.callback = callback
+        self.sr = sr
+        self.session = session
+        self.rows = []
+        self.latencies = []
+        model, (_, _, _, VADIterator, _) = stt.get_vad()
+        self.vad = VADIterator(model, threshold=stream_threshold, sampling_rate=sr,
+                               min_silence_duration_ms=stream_min_silence_ms, speech_pad_ms=stream_speech_pad_ms)
+        self._pending = np.zeros(0, dtype=np.float32)
+        self._windows = []  # Audio since _buffer_start, as VAD windows
+        self._buffer_start = 0  # Stream sample index of the first buffered sample
+        self._position = 0  # Stream samples seen by VAD so far
+        self._speech_start = None
+        self._utterances = 0
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._transcribe_loop, name="stream-asr", daemon=True)
+        self._worker.start()
+
+    def feed(self, block, arrived=None):
+        '''Adds a float32 block that arrived at perf_counter time arrived'''
+        import torch
+
+        arrived = time.perf_counter() if arrived is None else arrived
+        self._pending = np.concatenate([self._pending, block])
+        max_samples = int(self.sr * max_region_length / 1000)
+        # Outside speech only the pre-roll VAD may reach back to is kept
+        keep_windows = -(-int(self.sr * stream_speech_pad_ms / 1000) // VAD_WINDOW) + 1
+        n_windows = len(self._pending) // VAD_WINDOW
+        for i in range(n_windows):
+            window = self._pending[i * VAD_WINDOW:(i + 1) * VAD_WINDOW]
+            self._windows.append(window)
+            self._position += VAD_WINDOW
+            event = self.vad(torch.from_numpy(window), return_seconds=False)
+            if event and "start" in event:
+                self._speech_start = event["start"]
+            if event and "end" in event and self._speech_start is not None:
+                self._finalize(event["end"], arrived)
+            elif self._speech_start is not None and self._position - self._speech_start >= max_samples:
+                # Long monologue, hand over what we have and keep listening
+                self._finalize(self._position, arrived)
+                self._speech_start = self._position
+            if self._speech_start is None and len(self._windows) > keep_windows:
+                dropped = self._windows[:-keep_windows]
+                self._buffer_start += sum(len(w) for w in dropped)
+                del self._windows[:-keep_windows]
+        self._pending = self._pending[n_windows * VAD_WINDOW:].copy()
+
+    def _finalize(self, end, arrived):
+        # The speech pad can put VAD's end slightly past the audio seen so far
+        end = min(end, self._position)
+        start = max(self._speech_start, self._buffer_start)
+        buffer = np.concatenate(self._windows) if self._windows else np.zeros(0, dtype=np.float32)
+        chunk = buffer[start - self._buffer_start:end - self._buffer_start].copy()
+        # The sample at end was spoken (position - end) samples before the current window arrived
+        speech_end = arrived - (self._position - end) / self.sr
+        self._queue.put((chunk, start, speech_end, self._utterances))
+        self._utterances += 1
+        rest = buffer[end - self._buffer_start:]
+        self._windows = [rest] if len(rest) else []
+        self._buffer_start = end
+        self._speech_start = None
+        incr("stream_utterances")
+
+    def _transcribe_loop(self):
+        import stt
+        from sentiment import predict_sentiment
+
+        while (item := self._queue.get()) is not None:
+            chunk, start, speech_end, n = item
+            try:
+                with span("stream_utterance", samples=len(chunk)):
+                    segments, _ = stt.get_whisper_model().transcribe(chunk, word_timestamps=word_timestamps)
+                    rows = [stt._segment_row(segment, f"{self.session}_{n}", start / self.sr) for segment in segments]
+                    if rows:
+                        labels, probs = predict_sentiment([row["transcription"] for row in rows], return_probs=True)
+                        for row, label, prob in zip(rows, labels, probs):
+                            row["sentiment"] = label
+                            row.update({f"prob_{key.lower()}": value for key, value in prob.items()})
+            except Exception as e:
+                logging.error(f"Failed to transcribe utterance {n} : {str(e)}")
+                continue
+            if not rows:
+                continue
+            latency = time.perf_counter() - speech_end
+            self.latencies.append(latency)
+            for row in rows:
+                row["latency"] = round(latency, 3)
+            self.rows.extend(rows)
+            try:
+                self.callback(rows)
+            except Exception as e:
+                logging.error(f"Stream callback failed : {str(e)}")
+
+    def close(self):
+        '''Finalizes an utterance still in progress and waits for the transcriptions in flight'''
+        if self._speech_start is not None:
+            self._finalize(self._position, time.perf_counter())
+        self.vad.reset_states()
+        self._queue.put(None)
+        self._worker.join()
+
+    def latency_summary(self):
+        '''Returns the count and the p50/p90/p99/max end-to-end latency in seconds'''
+        if not self.latencies:
+            return {"utterances": 0}
+        p50, p90, p99 = np.percentile(self.latencies, [50, 90, 99]).tolist()
+        return {"utterances": len(self.latencies), "p50": round(p50, 3), "p90": round(p90, 3),
+                "p99": round(p99, 3), "max": round(max(self.latencies), 3)}
+
+
+def run_stream(source, callback=print_rows, session="stream", realtime=None, output_dir=None, sr=sample_rate):
+    '''Function that transcribes a live source until it ends or is interrupted and returns the latency summary.
+    With output_dir the rows are also saved as a session there at the end'''
+    import stt
+
+    stt.get_whisper_model()
+    transcriber = StreamTranscriber(callback, sr=sr, session=session)
+    logging.info(f"Listening on {'stdin' if source == '-' else source}")
+    try:
+        for block, arrived in pcm_source(source, sr=sr, realtime=realtime):
+            transcriber.feed(block, arrived)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        transcriber.close()
+
+    if output_dir and transcriber.rows:
+        from store import save_session
+
+        save_session([{k: v for k, v in row.items() if k != "latency"} for row in transcriber.rows], session, output_dir)
+    summary = transcriber.latency_summary()
+    logging.info(f"End-to-end latency: {summary}")
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Transcribe a live 16-bit mono PCM stream utterance by utterance")
+    parser.add_argument("source", help='"-" for stdin, a FIFO, or an audio/video file to replay in real time')
+    parser.add_argument("--session", default="stream", help="Session name of the rows")
+    parser.add_argument("--fast", action="store_true", help="Replay files as fast as possible instead of in real time")
+    parser.add_argument("--save", action="store_true", help=f"Save the rows as a session in {TRANSCRIBE_DIR} at the end")
+    args = parser.parse_args()
+    run_stream(args.source, session=args.session, realtime=not args.fast,
+               output_dir=TRANSCRIBE_DIR if args.save else None)
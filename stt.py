@@ -1,23 +1,133 @@
-from faster_whisper import WhisperModel
 import logging
 import os
-import torch
-from config import model_name,split_length
+import glob
+import json
+import bisect
+import functools
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+import numpy as np
+from config import model_name,compute_type,split_length,sample_rate,segmentation,vad_window,max_region_length,region_merge_gap,asr_engine,asr_batch_size,word_timestamps,num_workers,cpu_threads,sentiment_model,sentiment_backend,MODEL_CACHE_DIR,pcm_store,vad_gates,gate_frame_ms,gate_energy_db,gate_energy_margin_db,gate_zcr_min,gate_flatness_max,gate_pad_ms
 import pandas as pd
-from sentiment import get_sentiment
+from sentiment import predict_sentiment
+from utils import load_audio, load_recording, chunk_ranges, save_chunk
+from cache import get_cache, content_key
+from store import save_session, OUTPUT_COLUMNS
+from instrument import span, incr, traced_call, merge_traced
+from gate import candidate_spans
 import re
 
 
 logging.basicConfig(level=logging.INFO)
 
-model = WhisperModel(model_name, device = "cpu",compute_type="int8")
-mod, utils = torch.hub.load('snakers4/silero-vad','silero_vad',force_reload=True)
-(get_speech_timestamps, _, read_audio, _, _) = utils
+def worker_threads(workers = num_workers):
+    '''Function that returns the intra-op threads per worker, splitting the cores evenly when cpu_threads is 0'''
+    if cpu_threads > 0:
+        return cpu_threads
+    return max(1, (os.cpu_count() or 1) // max(1, workers))
+
 results = []
+_model_threads = None
+
+@functools.lru_cache(maxsize=None)
+def get_whisper_model():
+    '''Function that loads the Whisper model on first use. It is read from MODEL_CACHE_DIR without any
+    network access when cached there, and downloaded into it otherwise'''
+    from faster_whisper import WhisperModel
+
+    kwargs = dict(device = "cpu", compute_type = compute_type, cpu_threads = _model_threads or worker_threads(1),
+                  download_root = os.path.join(MODEL_CACHE_DIR, "whisper"))
+    with span("model_load", model="whisper"):
+        try:
+            return WhisperModel(model_name, local_files_only=True, **kwargs)
+        except Exception:
+            logging.info(f"Whisper model {model_name} not cached, downloading to {MODEL_CACHE_DIR}")
+            return WhisperModel(model_name, **kwargs)
+
+@functools.lru_cache(maxsize=None)
+def get_vad():
+    '''Function that loads silero VAD on first use and returns (model, utils). The hub repo is cached
+    under MODEL_CACHE_DIR and loaded from there without any network access once present'''
+    import torch
+
+    torch.hub.set_dir(os.path.join(MODEL_CACHE_DIR, "torch_hub"))
+    local_repo = glob.glob(os.path.join(torch.hub.get_dir(), "snakers4_silero-vad_*"))
+    with span("model_load", model="silero_vad"):
+        if local_repo:
+            return torch.hub.load(local_repo[0], 'silero_vad', source='local')
+
+        logging.info(f"Silero VAD not cached, downloading to {MODEL_CACHE_DIR}")
+        return torch.hub.load('snakers4/silero-vad', 'silero_vad', trust_repo=True)
+
+@functools.lru_cache(maxsize=None)
+def get_batched_pipeline():
+    '''Function that wraps the Whisper model in faster-whisper's batched long-form pipeline on first use'''
+    from faster_whisper import BatchedInferencePipeline
+
+    return BatchedInferencePipeline(model=get_whisper_model())
+
+def warm_up():
+    '''Function that loads the Whisper and VAD models ahead of the first transcription'''
+    get_whisper_model()
+    get_vad()
+
+def _init_worker(threads):
+    '''Initializer that loads the Whisper model once in each worker process'''
+    global _model_threads
+    import torch
+
+    _model_threads = threads
+    torch.set_num_threads(threads)
+    get_whisper_model()
+
+def worker_pool(workers = num_workers):
+    '''Function that starts the transcription worker pool, or returns None when workers is 1'''
+    if workers <= 1:
+        return None
+    threads = worker_threads(workers)
+    logging.info(f"Starting {workers} transcription workers with {threads} threads each")
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_init_worker, initargs=(threads,))
+
+def _completed(value):
+    '''Function that wraps an already known result, e.g. a cache hit, in a Future'''
+    future = Future()
+    future.set_result(value)
+    return future
+
+def _run(pool, fn, *args):
+    '''Function that submits fn to the pool, or runs it right away when there is no pool. Returns a Future either way.
+    Spans and counters recorded in a worker come back with its result and are merged into this process's trace'''
+    if pool is not None:
+        submitted = pool.submit(traced_call, fn, *args)
+        future = Future()
+
+        def unpack(done):
+            try:
+                future.set_result(merge_traced(done.result()))
+            except BaseException as e:
+                future.set_exception(e)
+        submitted.add_done_callback(unpack)
+        return future
+    future = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
 
 def is_speech(audio, sr = 16000, threshold = 0.1):
-    '''Function that check for Voice activity in the audio'''
-    wav = read_audio(audio, sampling_rate=sr)
+    '''Function that check for Voice activity in the audio. Accepts a file path or a float32 NumPy buffer'''
+    import torch
+
+    mod, (get_speech_timestamps, _, read_audio, _, _) = get_vad()
+    if isinstance(audio, np.ndarray):
+        if vad_gates and not candidate_spans(audio, sr=sr):
+            incr("gate_chunks_skipped")
+            return False
+        wav = torch.from_numpy(audio)
+    else:
+        wav = read_audio(audio, sampling_rate=sr)
 
     speech_timestamps = get_speech_timestamps(wav, mod, sampling_rate=sr)
 
@@ -34,6 +144,25 @@ def file_sorting(file_path):
     
     return (base_name, float('inf')) 
 
+def transcribe_file(audio_f):
+    '''Function that transcribes one segment file and returns its row, or None when it holds no speech'''
+    if not is_speech(audio_f):
+        return None
+
+    _, seg_idx = file_sorting(audio_f)
+    absolute_start = seg_idx * (split_length / 1000) 
+
+    segments, _ = get_whisper_model().transcribe(audio_f)
+    segments = list(segments)
+
+    actual_start = absolute_start + segments[0].start + 1
+
+    return {
+            "file": os.path.basename(audio_f),
+            "start": actual_start,
+            "transcription": segments[0].text
+        }
+
 def transcribe(audio_dir, output_dir):
     '''Function that transcribes the audio and saves it to a CSV file with sentiment analysis'''
     
@@ -56,39 +185,303 @@ def transcribe(audio_dir, output_dir):
     results = []  
     skipped_duration = 0 
 
-    for audio_f in audio_files:
-        try:
-            if not is_speech(audio_f):
-                logging.info(f"Skipping {audio_f} as it is not speech")
-                skipped_duration += split_length / 1000
-                continue
-            
-            _, seg_idx = file_sorting(audio_f)
-            absolute_start = seg_idx * (split_length / 1000) 
-            
-            segments, _ = model.transcribe(audio_f)
-            segments = list(segments)
-            
-            actual_start = absolute_start + segments[0].start + 1
-            
-            results.append({
-                    "file": os.path.basename(audio_f),
-                    "start": actual_start,
-                    "transcription": segments[0].text
-                })
-            
-            logging.info(f"Transcribed {audio_f}")
-            
-        except Exception as e:
-            logging.error(f"Failed to transcribe {audio_f} : {str(e)}")
+    pool = worker_pool()
+    try:
+        futures = [_run(pool, transcribe_file, audio_f) for audio_f in audio_files]
+
+        for audio_f, future in zip(audio_files, futures):
+            try:
+                row = future.result()
+                if row is None:
+                    logging.info(f"Skipping {audio_f} as it is not speech")
+                    skipped_duration += split_length / 1000
+                    continue
+
+                results.append(row)
+                logging.info(f"Transcribed {audio_f}")
+
+            except Exception as e:
+                logging.error(f"Failed to transcribe {audio_f} : {str(e)}")
+    finally:
+        if pool is not None:
+            pool.shutdown()
     
     audio_base_name = os.path.splitext(os.path.basename(audio_f))[0]
-    output_csv = os.path.join(output_dir, f"{audio_base_name}.csv")
-    os.makedirs(os.path.dirname(output_csv), exist_ok=True)
+    save_results(results, output_dir, audio_base_name)
+
+def save_results(results, output_dir, session):
+    '''Function that adds sentiment labels and probabilities to the transcription rows and saves the session.
+    Returns the rows with sentiment'''
+    df = pd.DataFrame(results, columns=["file", "start", "end", "transcription", "words"])
+    with span("sentiment", file=session, rows=len(df)):
+        labels, probs = predict_sentiment(df["transcription"].tolist(), return_probs=True)
+    df["sentiment"] = labels
+    df = df.join(pd.DataFrame(probs, index=df.index, dtype=float).rename(columns=lambda label: f"prob_{label.lower()}"))
+    rows = df.reindex(columns=OUTPUT_COLUMNS).to_dict("records")
+    with span("write", file=session):
+        save_session(rows, session, output_dir)
+    return rows
+
+def _asr_params():
+    return {"model": model_name, "compute_type": compute_type, "sample_rate": sample_rate, "segmentation": segmentation,
+            "asr_engine": asr_engine, "word_timestamps": word_timestamps}
+
+def _vad_params():
+    return {"vad_window": vad_window, "max_region_length": max_region_length, "region_merge_gap": region_merge_gap,
+            "vad_gates": list(vad_gates), "gate_frame_ms": gate_frame_ms, "gate_energy_db": gate_energy_db,
+            "gate_energy_margin_db": gate_energy_margin_db, "gate_zcr_min": gate_zcr_min,
+            "gate_flatness_max": gate_flatness_max, "gate_pad_ms": gate_pad_ms}
+
+def unit_params():
+    '''Settings a unit result depends on. Fixed-length units go through is_speech and its gates, so their
+    "no speech" decisions also depend on the VAD settings'''
+    return _asr_params() if segmentation == "vad" else {**_asr_params(), **_vad_params()}
+
+def unit_key(chunk, start, chunk_name):
+    '''Function that returns the result cache key of one unit of a recording'''
+    return content_key(chunk, start, chunk_name, unit_params())
+
+def recording_params():
+    return {**_asr_params(), **_vad_params(), "split_length": split_length, "sentiment_model": sentiment_model,
+            "sentiment_backend": sentiment_backend, "columns": OUTPUT_COLUMNS}
+
+def merge_regions(regions, max_gap, max_len):
+    '''Function that merges (start, end) regions closer than max_gap and cuts any region longer than max_len'''
+    merged = []
+    for start, end in sorted(regions):
+        if merged and start - merged[-1][1] <= max_gap and end - merged[-1][0] <= max_len:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+
+    capped = []
+    for start, end in merged:
+        for cut in range(start, end, max_len):
+            capped.append((cut, min(cut + max_len, end)))
+    return capped
 
-    df = pd.DataFrame(results)
-    df.to_csv(output_csv, index=False)
+def speech_regions(audio, sr = sample_rate, window = vad_window, max_length = max_region_length, merge_gap = region_merge_gap,
+                   gates = vad_gates):
+    '''Function that runs silero VAD once over the whole recording, window by window, and returns the
+    merged speech regions as (start, end) sample offsets. Within each window silero only sees the spans
+    that pass the NumPy pre-gates (see gate.py)'''
+    import torch
+
+    mod, (get_speech_timestamps, _, _, _, _) = get_vad()
+    step = int(sr * window / 1000)
+    regions = []
+    for offset in range(0, len(audio), step):
+        block = audio[offset:offset + step]
+        for span_start, span_end in candidate_spans(block, sr=sr, gates=gates):
+            wav = torch.from_numpy(np.ascontiguousarray(block[span_start:span_end]))
+            for ts in get_speech_timestamps(wav, mod, sampling_rate=sr):
+                regions.append((offset + span_start + ts['start'], offset + span_start + ts['end']))
+
+    return merge_regions(regions, int(sr * merge_gap / 1000), int(sr * max_length / 1000))
+
+def recording_units(audio, sr = sample_rate, audio_key = None):
+    '''Function that returns the (start, end) sample ranges of a recording that go to Whisper.
+    VAD regions are cached under audio_key, a content hash of the recording, when it is given'''
+    if segmentation != "vad":
+        return chunk_ranges(len(audio), sr=sr)
+
+    cache = get_cache()
+    key = content_key(audio_key, sr, _vad_params()) if cache and audio_key else None
+    regions = cache.get("vad", key) if key else None
+    if regions is None:
+        regions = speech_regions(audio, sr=sr)
+        if key:
+            cache.put("vad", key, regions)
+    return [tuple(region) for region in regions]
+
+def transcribe_unit(chunk, start, chunk_name, sr = sample_rate):
+    '''Function that transcribes one unit of a recording and returns its rows, or None when it holds no speech'''
+    with span("asr_unit", file=chunk_name):
+        if segmentation != "vad" and not is_speech(chunk, sr=sr):
+            return None
+
+        segments, _ = get_whisper_model().transcribe(chunk, word_timestamps=word_timestamps)
+        return [_segment_row(segment, chunk_name, start / sr) for segment in segments]
+
+def _segment_row(segment, chunk_name, offset = 0.0):
+    '''Function that turns a Whisper segment into an output row, shifting its times by offset seconds'''
+    words = [{"word": w.word, "start": round(offset + w.start, 3), "end": round(offset + w.end, 3),
+              "probability": round(w.probability, 3)} for w in (segment.words or [])]
+    return {
+            "file": chunk_name,
+            "start": offset + segment.start,
+            "end": offset + segment.end,
+            "transcription": segment.text,
+            "words": json.dumps(words)
+        }
+
+def transcribe_batched(audio, units, base_name, sr = sample_rate):
+    '''Function that transcribes a whole recording with faster-whisper's batched long-form inference and returns
+    every segment with word timestamps. VAD regions are passed as clip timestamps, fixed segmentation
+    lets the pipeline run its own VAD'''
+    if segmentation == "vad":
+        if not units:
+            return []
+        # faster-whisper slices the audio with these, so they are sample offsets rather than seconds
+        clips = [{"start": start, "end": end} for start, end in units]
+        segments, _ = get_batched_pipeline().transcribe(audio, batch_size=asr_batch_size, word_timestamps=word_timestamps,
+                                                        vad_filter=False, clip_timestamps=clips)
+    else:
+        segments, _ = get_batched_pipeline().transcribe(audio, batch_size=asr_batch_size, word_timestamps=word_timestamps,
+                                                        vad_filter=True)
+
+    unit_starts = [start / sr for start, _ in units]
+    rows = []
+    for segment in segments:
+        seg_idx = max(bisect.bisect_right(unit_starts, segment.start) - 1, 0)
+        rows.append(_segment_row(segment, f"{base_name}_{seg_idx}.wav"))
+    return rows
+
+def _start_recording(media_path, output_dir, pool = None, segment_dir = None, sr = sample_rate):
+    '''Function that decodes one recording, finds its units and submits them for transcription without waiting.
+    Returns the keyword arguments for _finish_recording, which collects the results'''
+    cache = get_cache()
+    audio_f = os.path.basename(media_path)
+    base_name = os.path.splitext(audio_f)[0]
+    pending = dict(audio_f=audio_f, output_dir=output_dir, session=base_name)
+
+    audio_key = cache.file_digest(media_path) if cache else None
+    recording_key = content_key(audio_key, recording_params()) if cache else None
+    cached_rows = cache.get("recording", recording_key) if cache else None
+    if cached_rows is not None:
+        incr("recordings_cached")
+        logging.info(f"Using cached results for {audio_f}")
+        return dict(pending, cached_rows=cached_rows)
+
+    with span("decode", file=audio_f):
+        audio = load_recording(media_path, sr=sr) if pcm_store else load_audio(media_path, sr=sr)
+    incr("recordings")
+    incr("audio_seconds", len(audio) / sr)
+    with span("vad", file=audio_f):
+        units = recording_units(audio, sr=sr, audio_key=audio_key)
+
+    jobs = [(audio[start:end], start, f"{base_name}_{seg_idx}.wav") for seg_idx, (start, end) in enumerate(units)]
+    if segment_dir:
+        os.makedirs(os.path.join(segment_dir, base_name), exist_ok=True)
+        for chunk, _, chunk_name in jobs:
+            save_chunk(chunk, os.path.join(segment_dir, base_name, chunk_name), sr=sr)
+
+    # Without a worker pool the units are transcribed right here, so this span is the ASR time. With one it only
+    # covers submission, the asr_unit spans merged back from the workers time the units themselves
+    with span("asr", file=audio_f, units=len(units)):
+        if asr_engine == "batched":
+            # One long-form call per recording, so the recording is the only unit
+            jobs = [(audio, 0, audio_f)]
+            unit_keys = [None]
+            futures = [_run(pool, transcribe_batched, audio, units, base_name, sr)]
+        else:
+            unit_keys = [unit_key(chunk, start, chunk_name) if cache else None for chunk, start, chunk_name in jobs]
+            futures = []
+            for i, (job, key) in enumerate(zip(jobs, unit_keys)):
+                cached_unit = cache.get("unit", key) if key else None
+                if cached_unit is not None:
+                    incr("units_cached")
+                    futures.append(_completed(cached_unit["rows"]))
+                    unit_keys[i] = None  # already in the cache
+                else:
+                    futures.append(_run(pool, transcribe_unit, *job, sr))
+    skipped_duration = len(audio) / sr - sum(end - start for start, end in units) / sr
+
+    return dict(pending, jobs=jobs, futures=futures, skipped_duration=skipped_duration,
+                recording_key=recording_key, unit_keys=unit_keys)
+
+def _finish_recording(audio_f, output_dir, session, jobs = (), futures = (), skipped_duration = 0, recording_key = None,
+                      unit_keys = (), cached_rows = None, sr = sample_rate):
+    '''Function that collects the unit results of a recording in order, saves them and stores them in the cache.
+    Returns the saved rows. When units failed, the rows that succeeded are still saved but nothing is cached and
+    a RuntimeError is raised afterwards, so callers can retry the recording'''
+    if cached_rows is not None:
+        save_session(cached_rows, session, output_dir)
+        return cached_rows
+
+    cache = get_cache()
+    results = []
+    failed = 0
+    with span("collect", file=audio_f):
+        for i, ((chunk, _, chunk_name), future) in enumerate(zip(jobs, futures)):
+            try:
+                rows = future.result()
+                # Only reached when the unit succeeded, so a failed unit is never cached
+                if cache and unit_keys and unit_keys[i]:
+                    cache.put("unit", unit_keys[i], {"rows": rows})
+                if rows is None:
+                    incr("units_skipped")
+                    skipped_duration += len(chunk) / sr
+                    continue
+                incr("units_processed")
+                results.extend(rows)
+            except Exception as e:
+                failed += 1
+                incr("units_failed")
+                logging.error(f"Failed to transcribe {chunk_name} : {str(e)}")
+
+    incr("skipped_seconds", skipped_duration)
+
+    logging.info(f"Transcribed {audio_f} in {len(jobs)} units, skipped {skipped_duration:.1f}s without speech")
+    rows = save_results(results, output_dir, session)
+    # A recording with failed units is incomplete, caching it would make the gap permanent
+    if failed:
+        raise RuntimeError(f"{failed} of {len(jobs)} units of {audio_f} failed, the saved session is incomplete")
+    if cache and recording_key:
+        cache.put("recording", recording_key, rows)
+    return rows
+
+def _finish_logged(pending, sr = sample_rate):
+    '''Function that finishes a recording, logging a failure instead of raising so the other recordings still run'''
+    try:
+        _finish_recording(**pending, sr=sr)
+    except Exception as e:
+        incr("recordings_failed")
+        logging.error(f"Failed to finish {pending['audio_f']} : {str(e)}")
+
+def transcribe_recording(media_path, output_dir, pool = None, segment_dir = None, sr = sample_rate):
+    '''Function that transcribes a single recording, adds sentiment and saves it as a session. Returns the saved rows.
+    Raises when any unit failed, after saving the rest'''
+    return _finish_recording(**_start_recording(media_path, output_dir, pool, segment_dir, sr), sr=sr)
+
+def transcribe_audio(audio_dir, output_dir, segment_dir=None, sr=sample_rate, extensions=('.wav',)):
+    '''Function that transcribes every recording in audio_dir without writing segments to disk.
+    Recordings are the files ending in one of extensions; passing ('.mp4',) decodes the videos directly.
+    Each recording is decoded once and its units (VAD speech regions or fixed split_length blocks,
+    see config.segmentation) are passed to Whisper as NumPy slices. With num_workers > 1 the units
+    are spread over a worker pool while the next recording is decoded, and results are reassembled in order.
+    If segment_dir is given the units are also saved there as WAV files for debugging.
+    When the result cache is on, unchanged recordings and units are read from it instead of being processed.'''
+
+    if not os.path.exists(audio_dir):
+        logging.error("Directory does not exist")
+        return
+
+    audio_files = sorted(f for f in os.listdir(audio_dir) if f.endswith(tuple(extensions)))
+    if not audio_files:
+        logging.error("No audio files found")
+        return
+
+    logging.info(f"Found {len(audio_files)} audio files")
+
+    pool = worker_pool()
+    pending = None
+    try:
+        for audio_f in audio_files:
+            try:
+                started = _start_recording(os.path.join(audio_dir, audio_f), output_dir, pool, segment_dir, sr)
+            except Exception as e:
+                incr("recordings_failed")
+                logging.error(f"Failed to load {audio_f} : {str(e)}")
+                continue
 
-    get_sentiment(output_csv, output_csv)
+            # Collect the previous recording only now so the pool stays busy while this one was decoded
+            if pending:
+                _finish_logged(pending, sr)
+            pending = started
 
-    logging.info(f"Transcription and sentiment saved to {output_csv}")
+        if pending:
+            _finish_logged(pending, sr)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
@@ -0,0 +1,67 @@
+# test_cache.py
+
+import unittest
+import os
+import time
+import shutil
+import tempfile
+
+from unittest import mock
+
+import cache
+from cache import ResultCache
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = ResultCache(os.path.join(self.dir, "cache.sqlite"), max_bytes=100)
+
+    def tearDown(self):
+        self.cache.conn.close()
+        shutil.rmtree(self.dir)
+
+    def test_put_and_get(self):
+        self.cache.put("unit", "a", [{"transcription": "hello"}])
+        self.assertEqual(self.cache.get("unit", "a"), [{"transcription": "hello"}])
+        self.assertIsNone(self.cache.get("unit", "b"))
+        self.assertIsNone(self.cache.get("vad", "a"))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        for key in ("a", "b", "c"):
+            self.cache.put("unit", key, "x" * 28)  # 30 bytes once JSON-encoded
+            time.sleep(0.01)
+        self.cache.get("unit", "a")
+        time.sleep(0.01)
+        self.cache.put("unit", "d", "x" * 28)
+        self.assertIsNone(self.cache.get("unit", "b"))
+        self.assertEqual(set(self.cache.get_many("unit", ["a", "b", "c", "d"])), {"a", "c", "d"})
+        self.assertLessEqual(sum(size for _, size in self.cache.stats().values()), 100)
+
+    def test_invalidate_one_kind_or_everything(self):
+        self.cache.put_many("unit", {"a": 1, "b": 2})
+        self.cache.put("vad", "a", 3)
+        self.assertEqual(self.cache.invalidate("unit"), 2)
+        self.assertEqual(self.cache.stats(), {"vad": (1, 1)})
+        self.assertEqual(self.cache.invalidate(), 1)
+        self.assertEqual(self.cache.stats(), {})
+
+    def test_file_digest_is_only_recomputed_when_the_file_changes(self):
+        path = os.path.join(self.dir, "rec.wav")
+        with open(path, "wb") as f:
+            f.write(b"first")
+        with mock.patch.object(cache, "file_digest", wraps=cache.file_digest) as digest:
+            first = self.cache.file_digest(path)
+            self.assertEqual(self.cache.file_digest(path), first)
+            self.assertEqual(digest.call_count, 1)
+
+            with open(path, "wb") as f:
+                f.write(b"second")
+            os.utime(path, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+            self.assertNotEqual(self.cache.file_digest(path), first)
+            self.assertEqual(digest.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+# test_gate.py
+
+import unittest
+import numpy as np
+
+from gate import gate_frames, candidate_spans, GATES
+
+SR = 16000
+
+
+def hum_with_voice(duration=10.0, voice=(4.0, 6.0), seed=0):
+    '''Quiet mains hum and hiss with a loud voiced harmonic burst between voice[0] and voice[1] seconds'''
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * SR)) / SR
+    audio = 0.01 * np.sin(2 * np.pi * 50 * t) + 0.002 * rng.standard_normal(len(t))
+    start, end = int(voice[0] * SR), int(voice[1] * SR)
+    audio[start:end] += 0.2 * sum(np.sin(2 * np.pi * 150 * k * t[start:end]) / k for k in range(1, 12))
+    return audio.astype(np.float32)
+
+
+class TestGate(unittest.TestCase):
+
+    def test_gate_frames_keep_only_the_voiced_burst(self):
+        stats = {}
+        keep, frame = gate_frames(hum_with_voice(), SR, gates=list(GATES), stats=stats)
+        self.assertEqual(frame, SR * 32 // 1000)
+        kept_seconds = np.flatnonzero(keep) * frame / SR
+        self.assertGreater(len(kept_seconds), 0)
+        self.assertGreaterEqual(kept_seconds.min(), 3.9)
+        self.assertLessEqual(kept_seconds.max(), 6.0)
+        self.assertEqual(sum(stats.values()), len(keep) - keep.sum())
+
+    def test_gate_frames_without_gates_keep_everything(self):
+        keep, _ = gate_frames(hum_with_voice(), SR, gates=())
+        self.assertTrue(keep.all())
+
+    def test_candidate_spans_pad_and_merge(self):
+        spans = candidate_spans(hum_with_voice(), SR, gates=list(GATES), pad_ms=300)
+        self.assertEqual(len(spans), 1)
+        start, end = spans[0]
+        self.assertLessEqual(start, int(3.7 * SR))
+        self.assertGreaterEqual(end, int(6.2 * SR))
+        self.assertGreaterEqual(start, int(3.5 * SR))
+        self.assertLessEqual(end, int(6.4 * SR))
+
+    def test_candidate_spans_stay_within_audio_shorter_than_the_pad(self):
+        audio = hum_with_voice(duration=0.5, voice=(0.2, 0.3))
+        self.assertEqual(candidate_spans(audio, SR, gates=list(GATES), pad_ms=300), [(0, len(audio))])
+        self.assertEqual(candidate_spans(audio, SR, gates=()), [(0, len(audio))])
+        self.assertEqual(candidate_spans(np.zeros(0, dtype=np.float32), SR, gates=list(GATES)), [])
+
+    def test_silence_has_no_candidates(self):
+        self.assertEqual(candidate_spans(np.zeros(5 * SR, dtype=np.float32), SR, gates=list(GATES)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# test_index.py
+
+import unittest
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+import index
+from index import TranscriptIndex
+from config import TRANSCRIBE_DIR
+
+ROWS = [
+    {"file": "a_0.wav", "start": 1.0, "end": 2.0, "sentiment": "NEG", "transcription": 'the brake-pedal failed, "again"'},
+    {"file": "a_1.wav", "start": 700.0, "end": 702.0, "sentiment": "POS", "transcription": "steering feels OK AND smooth"},
+    {"file": "a_2.wav", "start": 900.0, "end": 901.0, "sentiment": "NEG", "transcription": "brake again please"},
+]
+
+
+class TestTranscriptIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.index = TranscriptIndex(os.path.join(self.dir, "index.sqlite"))
+        self.index.index_session("drive", ROWS)
+
+    def tearDown(self):
+        self.index.conn.close()
+        shutil.rmtree(self.dir)
+
+    def starts(self, *args, **kwargs):
+        return self.index.query(*args, **kwargs)["start"].tolist()
+
+    def test_match_terms_quotes_every_word(self):
+        self.assertEqual(TranscriptIndex._match_terms('brake-pedal "again OR'), '"brake-pedal" """again" "OR"')
+        self.assertEqual(TranscriptIndex._match_terms("  "), "")
+
+    def test_punctuation_and_operators_are_searched_literally(self):
+        if not self.index.fts:
+            self.skipTest("SQLite without FTS5")
+        self.assertEqual(self.starts("brake-pedal"), [1.0])
+        self.assertEqual(self.starts('"again'), [1.0, 900.0])
+        self.assertEqual(self.starts("OK AND"), [700.0])
+        self.assertEqual(self.starts("brake NEAR"), [])
+        self.assertEqual(self.starts("stee*"), [])
+
+    def test_raw_queries_keep_fts5_syntax(self):
+        if not self.index.fts:
+            self.skipTest("SQLite without FTS5")
+        self.assertEqual(self.starts("stee* OR failed", raw=True), [1.0, 700.0])
+        self.assertEqual(self.starts('"brake again"', raw=True), [900.0])
+
+    def test_filters_and_reindexing(self):
+        self.assertEqual(self.starts("brake", sentiment="NEG", start=600), [900.0])
+        self.index.index_session("drive", ROWS[:1])
+        self.assertEqual(self.index.sessions(), {"drive": 1})
+        self.assertEqual(self.starts("brake"), [1.0])
+
+    def test_only_sessions_of_the_results_store_are_indexed(self):
+        shared = mock.Mock()
+        with mock.patch.object(index, "get_index", return_value=shared):
+            index.index_session("drive", ROWS, store_dir=self.dir)
+            shared.index_session.assert_not_called()
+            index.index_session("drive", ROWS, store_dir=TRANSCRIBE_DIR)
+            shared.index_session.assert_called_once_with("drive", ROWS)
+
+
+if __name__ == '__main__':
+    unittest.main()
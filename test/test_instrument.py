@@ -0,0 +1,60 @@
+# test_instrument.py
+
+import unittest
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import instrument
+from instrument import Tracer, traced_call, merge_traced
+
+
+def enable_tracing():
+    instrument.tracer.enabled = True
+
+
+def worker_task(n):
+    with instrument.span("asr_unit", file=f"unit_{n}"):
+        instrument.incr("units_processed")
+        instrument.incr("gate_frames", n)
+    return n * 2
+
+
+class TestTracer(unittest.TestCase):
+
+    def test_take_and_merge(self):
+        worker, parent = Tracer(enabled=True, profile=None), Tracer(enabled=True, profile=None)
+        with worker.span("model_load", model="whisper"):
+            worker.incr("units_processed", 2)
+        parent.incr("units_processed")
+        taken = worker.take()
+        self.assertEqual((worker.events, dict(worker.counters)), ([], {}))
+        parent.merge(taken)
+        self.assertEqual(parent.counters["units_processed"], 3)
+        self.assertEqual(parent.summary()["stages"]["model_load"]["count"], 1)
+        # Span times are rebased onto the parent's start
+        event = parent.events[0]
+        self.assertAlmostEqual(event["ts"], taken["events"][0]["ts"] + (worker._t0 - parent._t0) * 1e6)
+
+    def test_disabled_tracers_hand_nothing_over(self):
+        self.assertIsNone(Tracer(enabled=False, profile=None).take())
+        parent = Tracer(enabled=True, profile=None)
+        parent.merge(None)
+        self.assertEqual(parent.events, [])
+
+    def test_worker_process_counters_reach_the_parent(self):
+        saved = instrument.tracer
+        instrument.tracer = Tracer(enabled=True, profile=None)
+        try:
+            with ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=enable_tracing) as pool:
+                results = [merge_traced(future.result()) for future in [pool.submit(traced_call, worker_task, n) for n in (1, 2, 3)]]
+            self.assertEqual(results, [2, 4, 6])
+            summary = instrument.tracer.summary()
+            self.assertEqual(summary["counters"], {"units_processed": 3, "gate_frames": 6})
+            self.assertEqual(summary["stages"]["asr_unit"]["count"], 3)
+        finally:
+            instrument.tracer = saved
+
+
+if __name__ == '__main__':
+    unittest.main()
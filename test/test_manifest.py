@@ -0,0 +1,107 @@
+# test_manifest.py
+
+import unittest
+import os
+import time
+import shutil
+import tempfile
+from unittest import mock
+
+import stt
+from manifest import Manifest, process
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.recordings = []
+        for name in ("a.mp4", "b.mp4"):
+            path = os.path.join(self.dir, name)
+            with open(path, "wb") as f:
+                f.write(b"\0" * 16)
+            self.recordings.append(path)
+        self.manifest = Manifest(os.path.join(self.dir, "manifest.sqlite"), lease=0.2, attempts=2)
+
+    def tearDown(self):
+        self.manifest.conn.close()
+        shutil.rmtree(self.dir)
+
+    def test_add_queues_new_and_changed_recordings_only(self):
+        self.assertEqual(self.manifest.add(self.recordings), 2)
+        self.assertEqual(self.manifest.add(self.recordings), 0)
+        with open(self.recordings[0], "ab") as f:
+            f.write(b"\0")
+        self.assertEqual(self.manifest.add(self.recordings), 1)
+
+    def test_claim_is_exclusive(self):
+        self.manifest.add(self.recordings)
+        other = Manifest(self.manifest.path, lease=0.2, attempts=2)
+        claimed = {self.manifest.claim("w1"), other.claim("w2")}
+        other.conn.close()
+        self.assertEqual(claimed, set(self.recordings))
+        self.assertIsNone(self.manifest.claim("w3"))
+
+    def test_heartbeat_keeps_the_lease(self):
+        self.manifest.add(self.recordings[:1])
+        path = self.manifest.claim("w1")
+        for _ in range(3):
+            time.sleep(0.1)
+            self.assertTrue(self.manifest.heartbeat(path, "w1"))
+        self.assertIsNone(self.manifest.claim("w2"))
+        self.assertFalse(self.manifest.heartbeat(path, "w2"))
+
+    def test_expired_lease_is_reclaimed_and_the_old_worker_loses_it(self):
+        self.manifest.add(self.recordings[:1])
+        path = self.manifest.claim("w1")
+        time.sleep(0.3)
+        self.assertEqual(self.manifest.claim("w2"), path)
+        self.assertFalse(self.manifest.heartbeat(path, "w1"))
+        self.assertFalse(self.manifest.finish(path, "w1"))
+        self.assertTrue(self.manifest.finish(path, "w2"))
+        counts, _ = self.manifest.status()
+        self.assertEqual(counts, {"done": 1})
+
+    def test_expired_lease_without_attempts_left_is_failed(self):
+        self.manifest.add(self.recordings[:1])
+        for worker in ("w1", "w2"):
+            self.assertIsNotNone(self.manifest.claim(worker))
+            time.sleep(0.3)
+        self.assertIsNone(self.manifest.claim("w3"))
+        counts, rows = self.manifest.status()
+        self.assertEqual(counts, {"failed": 1})
+        self.assertEqual(rows[0][4], 2)
+
+    def test_failed_recording_is_retried_until_attempts_run_out(self):
+        self.manifest.add(self.recordings[:1])
+        path = self.manifest.claim("w1")
+        self.manifest.finish(path, "w1", error="boom")
+        self.assertEqual(self.manifest.claim("w2"), path)
+        self.manifest.finish(path, "w2", error="boom")
+        self.assertIsNone(self.manifest.claim("w3"))
+
+        self.assertEqual(self.manifest.retry(), 1)
+        self.assertEqual(self.manifest.claim("w3"), path)
+
+    def test_completed_stages_are_kept_until_the_recording_changes(self):
+        self.manifest.add(self.recordings[:1])
+        path = self.manifest.claim("w1")
+        self.manifest.complete_stage(path, "extract", "w1", 1.0)
+        self.assertEqual(self.manifest.completed_stages(path), {"extract"})
+        with open(path, "ab") as f:
+            f.write(b"\0")
+        self.manifest.add([path])
+        self.assertEqual(self.manifest.completed_stages(path), set())
+
+    def test_failed_transcription_leaves_the_stage_open(self):
+        self.manifest.add(self.recordings[:1])
+        path = self.manifest.claim("w1")
+        with mock.patch("manifest.extract_wav", False), \
+             mock.patch.object(stt, "transcribe_recording", side_effect=RuntimeError("1 of 3 units failed")):
+            with self.assertRaises(RuntimeError):
+                process(self.manifest, path, "w1", output_dir=self.dir)
+        self.assertEqual(self.manifest.completed_stages(path), set())
+
+
+if __name__ == '__main__':
+    unittest.main()
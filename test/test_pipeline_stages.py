@@ -0,0 +1,85 @@
+# test_pipeline_stages.py
+
+import unittest
+import os
+import shutil
+import asyncio
+import tempfile
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+import pipeline
+from cache import ResultCache
+
+SR = 16000
+
+
+def fake_transcribe_unit(chunk, start, chunk_name, sr=SR):
+    if chunk_name.endswith("_1.wav") and fake_transcribe_unit.fail:
+        raise RuntimeError("boom")
+    return [{"file": chunk_name, "start": start / sr, "end": (start + len(chunk)) / sr, "transcription": "hello"}]
+
+
+class TestOverlappedStages(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = ResultCache(os.path.join(self.dir, "cache.sqlite"))
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        fake_transcribe_unit.fail = False
+        patches = [mock.patch.object(pipeline, "get_cache", return_value=self.cache),
+                   mock.patch.object(pipeline, "asr_engine", "chunked"),
+                   mock.patch.object(pipeline, "transcribe_unit", side_effect=fake_transcribe_unit)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        self.cache.conn.close()
+        shutil.rmtree(self.dir)
+
+    def run_asr(self, units):
+        async def run():
+            loop = asyncio.get_running_loop()
+            in_q, out_q = asyncio.Queue(), asyncio.Queue()
+            await in_q.put(("rec.wav", np.ones(4 * SR, dtype=np.float32), units, "recording-key", None))
+            await in_q.put(pipeline._END)
+            await pipeline._asr_stage(loop, self.executor, in_q, out_q, SR)
+            items = []
+            while (item := out_q.get_nowait()) is not pipeline._END:
+                items.append(item)
+            return items
+        return asyncio.run(run())
+
+    def test_asr_stage_reuses_cached_units(self):
+        units = [(0, SR), (SR, 2 * SR), (3 * SR, 4 * SR)]
+        fake_transcribe_unit.fail = True
+        first = self.run_asr(units)
+        self.assertEqual(first[-1], ("end", "rec.wav", None))  # a failed unit keeps the recording out of the cache
+        self.assertEqual(pipeline.transcribe_unit.call_count, 3)
+        self.assertEqual(self.cache.stats()["unit"][0], 2)
+
+        fake_transcribe_unit.fail = False
+        second = self.run_asr(units)
+        # Only the unit that failed is transcribed again, the rows come out in unit order
+        self.assertEqual(pipeline.transcribe_unit.call_count, 4)
+        self.assertEqual([rows[0]["file"] for kind, _, rows in second if kind == "rows"],
+                         ["rec_0.wav", "rec_1.wav", "rec_2.wav"])
+        self.assertEqual(second[-1], ("end", "rec.wav", "recording-key"))
+
+    def test_vad_stage_passes_the_file_digest(self):
+        async def run():
+            loop = asyncio.get_running_loop()
+            in_q, out_q = asyncio.Queue(), asyncio.Queue()
+            await in_q.put(("rec.wav", np.zeros(SR, dtype=np.float32), "digest", "recording-key", None))
+            await in_q.put(pipeline._END)
+            with mock.patch.object(pipeline, "recording_units", return_value=[(0, SR)]) as units:
+                await pipeline._vad_stage(loop, self.executor, in_q, out_q, SR)
+            return units.call_args
+        self.assertEqual(asyncio.run(run()).args[2], "digest")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+# test_sentiment.py
+
+import unittest
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+import sentiment
+from cache import ResultCache
+
+
+def fake_predict_batch(texts, backend=None):
+    '''Stands in for the model: the label is decided by the text, and every batch is recorded'''
+    fake_predict_batch.batches.append(list(texts))
+    labels = ["NEG" if "bad" in text else "POS" if "good" in text else "NEU" for text in texts]
+    return labels, [{"NEG": float(label == "NEG"), "NEU": float(label == "NEU"), "POS": float(label == "POS")}
+                    for label in labels]
+
+
+class SentimentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        fake_predict_batch.batches = []
+        sentiment._memo.clear()
+        sentiment._memo_counts.clear()
+        self.version = {"model": "test", "revision": "r1", "backend": "torch"}
+        patches = [mock.patch.object(sentiment, "_predict_batch", side_effect=fake_predict_batch),
+                   mock.patch.object(sentiment, "model_version", side_effect=lambda: self.version),
+                   mock.patch.object(sentiment, "get_cache", return_value=None)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(sentiment._memo.clear)
+
+
+class TestPredictSentiment(SentimentTestCase):
+
+    def test_labels_follow_the_input_order_after_length_bucketing(self):
+        texts = ["a rather long and good sentence about the drive", "bad", "ok then", "good", "so bad it hurts"]
+        labels, probs = sentiment.predict_sentiment(texts, batch_size=2, return_probs=True)
+        self.assertEqual(labels, ["POS", "NEG", "NEU", "POS", "NEG"])
+        self.assertEqual([max(prob, key=prob.get) for prob in probs], labels)
+        # Batches go through the model shortest first
+        lengths = [len(text) for batch in fake_predict_batch.batches for text in batch]
+        self.assertEqual(lengths, sorted(lengths))
+        self.assertTrue(all(len(batch) <= 2 for batch in fake_predict_batch.batches))
+
+    def test_empty_and_missing_texts(self):
+        self.assertEqual(sentiment.predict_sentiment([]), [])
+        self.assertEqual(sentiment.predict_sentiment([None, float("nan"), "good"]), ["NEU", "NEU", "POS"])
+
+
+class TestMemo(SentimentTestCase):
+
+    def test_normalization_keeps_case(self):
+        self.assertEqual(sentiment.normalize_text("  NO\tway \n"), "NO way")
+        self.assertEqual(sentiment.normalize_text("ｂａｄ"), "bad")
+        self.assertEqual(sentiment.normalize_text(None), "")
+
+    def test_repeats_hit_the_memory_memo(self):
+        sentiment.predict_sentiment(["good", "good ", "bad", "NO"])
+        self.assertEqual(sentiment.memo_stats()["misses"], 3)
+        sentiment.predict_sentiment(["good", "no", "bad"])
+        stats = sentiment.memo_stats()
+        self.assertEqual((stats["memory_hits"], stats["disk_hits"], stats["misses"]), (2, 0, 4))
+        self.assertEqual(stats["memory_entries"], 4)
+        self.assertEqual(stats["hit_rate"], round(2 / 6, 4))
+        self.assertEqual(sum(len(batch) for batch in fake_predict_batch.batches), 4)
+
+    def test_result_cache_serves_a_fresh_process(self):
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        cache = ResultCache(os.path.join(workdir, "cache.sqlite"))
+        self.addCleanup(cache.conn.close)
+        with mock.patch.object(sentiment, "get_cache", return_value=cache):
+            first = sentiment.predict_sentiment(["good", "bad"], return_probs=True)
+            sentiment._memo.clear()
+            second = sentiment.predict_sentiment(["good", "bad"], return_probs=True)
+        self.assertEqual(first, second)
+        stats = sentiment.memo_stats()
+        self.assertEqual((stats["memory_hits"], stats["disk_hits"], stats["misses"]), (0, 2, 2))
+
+    def test_keys_change_with_the_model_version(self):
+        sentiment.predict_sentiment(["good"])
+        self.version = {**self.version, "backend": "onnx_int8"}
+        sentiment.predict_sentiment(["good"])
+        self.version = {**self.version, "revision": "r2"}
+        sentiment.predict_sentiment(["good"])
+        self.assertEqual(sentiment.memo_stats()["misses"], 3)
+        self.assertEqual(len(fake_predict_batch.batches), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+# test_store.py
+
+import unittest
+import os
+import shutil
+import tempfile
+import pyarrow.dataset as ds
+
+from store import write_session, read_session, read_metadata, read_dataset, export_csv, model_metadata, OUTPUT_COLUMNS
+
+
+def rows(n, offset=0.0):
+    return [{"file": f"s_{i}.wav", "start": offset + i, "end": offset + i + 0.5, "transcription": f"line {i}",
+             "words": "[]", "sentiment": ["NEG", "NEU", "POS"][i % 3], "prob_neg": 0.1, "prob_neu": 0.2, "prob_pos": 0.7}
+            for i in range(n)]
+
+
+class TestStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_write_and_read_session(self):
+        path = write_session(rows(3), "drive_01", self.dir)
+        self.assertEqual(path, os.path.join(self.dir, "drive_01.parquet"))
+        self.assertFalse(os.path.exists(path + ".tmp"))
+        df = read_session(path)
+        self.assertEqual(list(df.columns), ["session"] + OUTPUT_COLUMNS)
+        self.assertEqual(df["session"].unique().tolist(), ["drive_01"])
+        self.assertEqual(df["start"].tolist(), [0.0, 1.0, 2.0])
+        self.assertEqual(df["sentiment"].tolist(), ["NEG", "NEU", "POS"])
+        self.assertEqual(list(read_session(path, columns=["start", "sentiment"]).columns), ["start", "sentiment"])
+        self.assertEqual(read_metadata(path), model_metadata())
+
+    def test_missing_columns_are_written_as_nulls(self):
+        path = write_session([{"file": "a.wav", "start": 1.0, "transcription": "hi"}], "partial", self.dir)
+        df = read_session(path)
+        self.assertTrue(df["sentiment"].isna().all())
+        self.assertTrue(df["prob_pos"].isna().all())
+
+    def test_read_dataset_across_sessions(self):
+        write_session(rows(3), "a", self.dir)
+        write_session(rows(4, offset=100.0), "b", self.dir)
+        write_session([], "empty", self.dir)
+        df = read_dataset(self.dir)
+        self.assertEqual(len(df), 7)
+        self.assertEqual(sorted(df["session"].unique()), ["a", "b"])
+
+        neg = read_dataset(self.dir, columns=["session", "start"], filter=ds.field("sentiment") == "NEG")
+        self.assertEqual(list(neg.columns), ["session", "start"])
+        self.assertEqual(sorted(zip(neg["session"], neg["start"])), [("a", 0.0), ("b", 100.0), ("b", 103.0)])
+
+    def test_export_csv_round_trip(self):
+        csv_path = export_csv(write_session(rows(2), "s", self.dir))
+        df = read_session(csv_path)
+        self.assertEqual(list(df.columns), OUTPUT_COLUMNS)
+        self.assertEqual(df["transcription"].tolist(), ["line 0", "line 1"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+# test_stt.py
+
+import unittest
+from types import SimpleNamespace
+from concurrent.futures import Future
+from unittest import mock
+import numpy as np
+
+import stt
+from stt import merge_regions
+
+
+class TestMergeRegions(unittest.TestCase):
+
+    def test_close_regions_are_merged(self):
+        self.assertEqual(merge_regions([(0, 100), (150, 300)], max_gap=50, max_len=1000), [(0, 300)])
+
+    def test_distant_regions_stay_apart(self):
+        self.assertEqual(merge_regions([(0, 100), (151, 300)], max_gap=50, max_len=1000), [(0, 100), (151, 300)])
+
+    def test_unsorted_and_overlapping_regions(self):
+        self.assertEqual(merge_regions([(500, 600), (0, 200), (100, 150)], max_gap=10, max_len=1000),
+                         [(0, 200), (500, 600)])
+
+    def test_merge_never_exceeds_max_len(self):
+        self.assertEqual(merge_regions([(0, 600), (620, 1000)], max_gap=50, max_len=800), [(0, 600), (620, 1000)])
+
+    def test_long_regions_are_cut(self):
+        self.assertEqual(merge_regions([(0, 2500)], max_gap=50, max_len=1000), [(0, 1000), (1000, 2000), (2000, 2500)])
+
+    def test_empty(self):
+        self.assertEqual(merge_regions([], max_gap=50, max_len=1000), [])
+
+
+class FakeBatchedPipeline:
+    '''Records the transcribe() arguments and returns one segment per clip, in seconds like faster-whisper'''
+
+    def __init__(self, sr):
+        self.sr = sr
+        self.kwargs = None
+
+    def transcribe(self, audio, **kwargs):
+        self.kwargs = kwargs
+        clips = kwargs.get("clip_timestamps") or [{"start": 0, "end": len(audio)}]
+        # collect_chunks slices the audio with the clip bounds, which only works for integer samples
+        segments = [SimpleNamespace(start=clip["start"] / self.sr, end=clip["end"] / self.sr,
+                                    text=f"clip {len(audio[clip['start']:clip['end']])}", words=None)
+                    for clip in clips]
+        return iter(segments), None
+
+
+class TestTranscribeBatched(unittest.TestCase):
+
+    def test_clips_are_sample_offsets_and_segments_map_to_their_unit(self):
+        sr = 16000
+        audio = np.zeros(10 * sr, dtype=np.float32)
+        units = [(0, 2 * sr), (3 * sr, 5 * sr), (8 * sr, 10 * sr)]
+        pipeline = FakeBatchedPipeline(sr)
+        with mock.patch.object(stt, "get_batched_pipeline", return_value=pipeline), \
+             mock.patch.object(stt, "segmentation", "vad"):
+            rows = stt.transcribe_batched(audio, units, "session", sr=sr)
+
+        self.assertEqual(pipeline.kwargs["clip_timestamps"], [{"start": start, "end": end} for start, end in units])
+        self.assertTrue(all(isinstance(value, int) for clip in pipeline.kwargs["clip_timestamps"] for value in clip.values()))
+        self.assertFalse(pipeline.kwargs["vad_filter"])
+        self.assertEqual([row["file"] for row in rows], ["session_0.wav", "session_1.wav", "session_2.wav"])
+        self.assertEqual([row["start"] for row in rows], [0.0, 3.0, 8.0])
+        self.assertEqual([row["transcription"] for row in rows], ["clip 32000"] * 3)
+
+    def test_no_units_means_no_call(self):
+        pipeline = FakeBatchedPipeline(16000)
+        with mock.patch.object(stt, "get_batched_pipeline", return_value=pipeline), \
+             mock.patch.object(stt, "segmentation", "vad"):
+            self.assertEqual(stt.transcribe_batched(np.zeros(100, dtype=np.float32), [], "session"), [])
+        self.assertIsNone(pipeline.kwargs)
+
+
+class TestUnitParams(unittest.TestCase):
+
+    def test_fixed_units_depend_on_the_gate_settings(self):
+        with mock.patch.object(stt, "segmentation", "fixed"):
+            before = stt.unit_params()
+            with mock.patch.object(stt, "gate_energy_margin_db", 12):
+                self.assertNotEqual(stt.unit_params(), before)
+            with mock.patch.object(stt, "vad_gates", ("zcr",)):
+                self.assertNotEqual(stt.unit_params(), before)
+
+    def test_vad_units_do_not(self):
+        with mock.patch.object(stt, "segmentation", "vad"):
+            before = stt.unit_params()
+            with mock.patch.object(stt, "gate_energy_margin_db", 12):
+                self.assertEqual(stt.unit_params(), before)
+
+
+def finished(result=None, error=None):
+    future = Future()
+    if error:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+    return future
+
+
+class TestFinishRecording(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = mock.Mock()
+        patches = [mock.patch.object(stt, "get_cache", return_value=self.cache),
+                   mock.patch.object(stt, "save_results", side_effect=lambda results, output_dir, session: results)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        chunk = np.zeros(160, dtype=np.float32)
+        self.jobs = [(chunk, 0, "s_0.wav"), (chunk, 160, "s_1.wav")]
+
+    def test_complete_recording_is_cached(self):
+        rows = stt._finish_recording("s.wav", "out", "s", self.jobs, [finished([{"a": 1}]), finished([{"a": 2}])],
+                                     recording_key="rec", unit_keys=["u0", "u1"])
+        self.assertEqual(rows, [{"a": 1}, {"a": 2}])
+        self.cache.put.assert_any_call("recording", "rec", rows)
+
+    def test_failed_unit_raises_after_saving_the_rest(self):
+        with self.assertRaises(RuntimeError):
+            stt._finish_recording("s.wav", "out", "s", self.jobs, [finished([{"a": 1}]), finished(error=ValueError("boom"))],
+                                  recording_key="rec", unit_keys=["u0", "u1"])
+        stt.save_results.assert_called_once_with([{"a": 1}], "out", "s")
+        self.assertEqual(self.cache.put.call_args_list, [mock.call("unit", "u0", {"rows": [{"a": 1}]})])
+
+
+if __name__ == '__main__':
+    unittest.main()
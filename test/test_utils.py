@@ -0,0 +1,72 @@
+# test_utils.py
+
+import unittest
+import os
+import shutil
+import tempfile
+from unittest import mock
+import numpy as np
+
+import utils
+from utils import write_pcm, load_recording, read_range, pcm_paths
+
+
+def fake_stream_pcm(n_samples, fail=False):
+    '''Stands in for ffmpeg, yielding an int16 ramp in blocks of 1000 samples'''
+    def stream(media_path, sr=16000, block_seconds=None):
+        ramp = (np.arange(n_samples) % 20000).astype(np.int16)
+        for start in range(0, n_samples, 1000):
+            yield ramp[start:start + 1000]
+        if fail:
+            raise RuntimeError("ffmpeg failed")
+    return stream
+
+
+class TestPcmStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = os.path.join(self.dir, "store")
+        self.video = os.path.join(self.dir, "drive.mp4")
+        with open(self.video, "wb") as f:
+            f.write(b"video")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_write_pcm_patches_the_placeholder_header(self):
+        with mock.patch.object(utils, "stream_pcm", fake_stream_pcm(12345)):
+            meta = write_pcm(self.video, self.store)
+        npy_path, meta_path = pcm_paths(self.video, self.store)
+        audio = np.load(npy_path, mmap_mode="r")
+        self.assertEqual(audio.shape, (12345,))
+        self.assertEqual(audio.dtype, np.float32)
+        np.testing.assert_allclose(audio[:5], np.arange(5) / 32768.0)
+        self.assertEqual(meta["samples"], 12345)
+        self.assertEqual(meta["source"], os.path.abspath(self.video))
+        self.assertEqual(sorted(os.listdir(self.store)), ["drive.json", "drive.npy"])
+
+    def test_failed_decode_leaves_nothing_behind(self):
+        with mock.patch.object(utils, "stream_pcm", fake_stream_pcm(5000, fail=True)):
+            with self.assertRaises(RuntimeError):
+                write_pcm(self.video, self.store)
+        self.assertEqual(os.listdir(self.store), [])
+
+    def test_load_recording_decodes_once_per_source(self):
+        stream = mock.Mock(side_effect=fake_stream_pcm(32000))
+        with mock.patch.object(utils, "stream_pcm", stream):
+            first = load_recording(self.video, self.store)
+            second = load_recording(self.video, self.store)
+            self.assertEqual(stream.call_count, 1)
+            np.testing.assert_array_equal(first, second)
+            self.assertEqual(len(read_range(self.video, 0.5, 1.0, self.store)), 8000)
+
+            # Same name, other file: the store must not hand back the video's samples
+            wav = os.path.join(self.dir, "drive.wav")
+            shutil.copy(self.video, wav)
+            load_recording(wav, self.store)
+            self.assertEqual(stream.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+# test_visualization.py
+
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from matplotlib.patches import StepPatch
+
+from visualization import (aggregate_session, aggregate_sessions, _add_aggregates, _coarsen, build_pyramid,
+                           word_buckets_figure, TimelineView, SENTIMENTS)
+
+
+def session(starts, texts, sentiments):
+    return pd.DataFrame({"start": starts, "transcription": texts, "sentiment": sentiments})
+
+
+class TestAggregates(unittest.TestCase):
+
+    def test_aggregate_session_buckets(self):
+        df = session([0.0, 4.9, 5.0, 12.0, None, -1.0], ["a b", "c", "d e f", None, "x", "y"],
+                     ["NEG", "POS", "NEU", "POS", "NEG", "NEG"])
+        agg = aggregate_session(df, bucket_size=5)
+        self.assertEqual(agg["bucket_size"], 5)
+        np.testing.assert_array_equal(agg["words"], [3, 3, 0])
+        np.testing.assert_array_equal(agg["utterances"], [2, 1, 1])
+        np.testing.assert_array_equal(agg["sentiment"], [[1, 0, 1], [0, 1, 0], [0, 0, 1]])
+
+    def test_aggregate_session_without_sentiment_or_rows(self):
+        agg = aggregate_session(pd.DataFrame({"start": [1.0], "transcription": ["hi"]}), bucket_size=5)
+        np.testing.assert_array_equal(agg["sentiment"], [[0] * len(SENTIMENTS)])
+        empty = aggregate_session(session([], [], []), bucket_size=5)
+        self.assertEqual(len(empty["words"]), 0)
+        self.assertEqual(empty["sentiment"].shape, (0, len(SENTIMENTS)))
+
+    def test_add_aggregates_pads_the_shorter_one(self):
+        short = aggregate_session(session([1.0], ["a"], ["NEG"]), bucket_size=5)
+        long = aggregate_session(session([1.0, 14.0], ["a b", "c"], ["POS", "POS"]), bucket_size=5)
+        total = _add_aggregates(None, short)
+        total = _add_aggregates(total, long)
+        np.testing.assert_array_equal(total["words"], [3, 0, 1])
+        np.testing.assert_array_equal(total["utterances"], [2, 0, 1])
+        np.testing.assert_array_equal(total["sentiment"], [[1, 0, 1], [0, 0, 0], [0, 0, 1]])
+        # The first aggregate is copied, not summed into
+        np.testing.assert_array_equal(short["words"], [1])
+
+
+class TestSummary(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_summary_reports_the_end_of_the_last_utterance(self):
+        path = os.path.join(self.dir, "a.csv")
+        pd.DataFrame({"file": ["a_0.wav", "a_1.wav"], "start": [1.0, 62.0], "end": [4.0, 75.5],
+                      "transcription": ["a b", "c"], "sentiment": ["POS", "NEG"]}).to_csv(path, index=False)
+        total, summary = aggregate_sessions([path], bucket_size=60)
+        self.assertEqual(summary.loc[0, "speech_end"], 75.5)  # not the 120 s end of the last bucket
+        self.assertEqual(summary.loc[0, "words"], 3)
+        np.testing.assert_array_equal(total["words"], [2, 1])
+
+    def test_word_buckets_are_drawn_on_a_numeric_time_axis(self):
+        agg = aggregate_session(session([1.0, 70.0], ["a b", "c"], ["POS", "NEG"]), bucket_size=60)
+        ax = word_buckets_figure(agg).axes[0]
+        steps = [p for p in ax.patches if isinstance(p, StepPatch)]
+        self.assertEqual(len(steps), 1)
+        np.testing.assert_array_equal(steps[0].get_data().edges, [0, 60, 120])
+        self.assertEqual(ax.get_xlim(), (0, 120))
+
+
+class TestPyramid(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.df = session(np.sort(rng.uniform(0, 3000, 500)), ["one two"] * 500, rng.choice(SENTIMENTS, 500))
+
+    def test_coarsen_sums_and_pads(self):
+        agg = aggregate_session(session([0.0, 6.0, 11.0], ["a", "b c", "d"], ["NEG", "NEU", "POS"]), bucket_size=5)
+        coarse = _coarsen(agg, 2, 10)
+        self.assertEqual(coarse["bucket_size"], 10)
+        np.testing.assert_array_equal(coarse["words"], [3, 1])
+        np.testing.assert_array_equal(coarse["sentiment"], [[1, 1, 0], [0, 0, 1]])
+
+    def test_build_pyramid_levels_agree_with_direct_aggregation(self):
+        pyramid = build_pyramid(self.df, levels=(5, 30, 300))
+        self.assertEqual(sorted(pyramid), [5, 30, 300])
+        for level, agg in pyramid.items():
+            self.assertEqual(agg["words"].sum(), 1000)
+            self.assertEqual(agg["sentiment"].sum(), 500)
+            direct = aggregate_session(self.df, level)
+            np.testing.assert_array_equal(agg["words"][:len(direct["words"])], direct["words"])
+            self.assertFalse(agg["words"][len(direct["words"]):].any())
+
+    def test_build_pyramid_rejects_levels_that_are_not_multiples(self):
+        with self.assertRaises(ValueError):
+            build_pyramid(self.df, levels=(5, 12))
+
+    def test_timeline_level_for_span(self):
+        view = TimelineView(Figure(), build_pyramid(self.df, levels=(5, 30, 300)), max_bars=100)
+        self.assertEqual(view.level_for(500), 5)
+        self.assertEqual(view.level_for(501), 30)
+        self.assertEqual(view.level_for(3000), 30)
+        self.assertEqual(view.level_for(30000), 300)
+        self.assertEqual(view.level_for(10 ** 7), 300)
+        # The whole session is 3000 s, drawn at the 30 s level; zooming in switches to 5 s buckets
+        self.assertEqual(view.drawn[0], 30)
+        view.words_ax.set_xlim(1000, 1200)
+        self.assertEqual(view.drawn[0], 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,9 +3,16 @@ from tkinter import filedialog, messagebox, ttk
 import sys
 import logging
 import os
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from PIL import Image, ImageTk
-from visualization import generate_time_bucket_histogram, generate_sentiment_visualization
+import queue
+import threading
+from collections import OrderedDict
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+from store import read_session, session_path
+from index import get_index
+from config import TRANSCRIBE_DIR
+from visualization import load_pyramid, timeline_figure, sentiment_figure
+
+MAX_CACHED_FIGURES = 4  # rendered sessions kept for switching back, each holds its figures and timeline pyramid
 
 
 class CommunicationAnalysisApp:
@@ -24,6 +31,11 @@ class CommunicationAnalysisApp:
         master.configure(bg=self.secondary_color)
         master.option_add("*Font", "Helvetica 10")
 
+        # Rendered figures keyed by (file path, mtime), least recently shown first, and the queue the render
+        # thread reports through
+        self.figure_cache = OrderedDict()
+        self.render_queue = queue.Queue()
+
         # Create and configure styles
         self.configure_styles()
 
@@ -68,14 +80,76 @@ class CommunicationAnalysisApp:
         browse_button = ttk.Button(file_frame, text="Browse", command=self.upload_file)
         browse_button.pack(side=tk.LEFT)
 
+        self.create_search_frame(content_frame)
+
         self.plot_frame = ttk.Frame(content_frame)
         self.plot_frame.pack(fill=tk.BOTH, expand=True)
 
-        generate_button = ttk.Button(content_frame, text="Generate Visualizations", command=self.generate_visualizations)
-        generate_button.pack(pady=10)
+        self.generate_button = ttk.Button(content_frame, text="Generate Visualizations", command=self.generate_visualizations)
+        self.generate_button.pack(pady=10)
+
+    def create_search_frame(self, parent):
+        search_frame = ttk.Frame(parent)
+        search_frame.pack(fill=tk.X, pady=(10, 0))
+        self.search_text = tk.StringVar()
+        self.search_sentiment = tk.StringVar(value="All")
+        self.search_from = tk.StringVar()
+        self.search_to = tk.StringVar()
+        ttk.Label(search_frame, text="Search:").pack(side=tk.LEFT)
+        search_entry = ttk.Entry(search_frame, textvariable=self.search_text, width=30)
+        search_entry.pack(side=tk.LEFT, padx=5)
+        search_entry.bind("<Return>", lambda event: self.search())
+        ttk.Combobox(search_frame, textvariable=self.search_sentiment, values=["All", "NEG", "NEU", "POS"],
+                     width=5, state="readonly").pack(side=tk.LEFT, padx=5)
+        ttk.Label(search_frame, text="From (min):").pack(side=tk.LEFT)
+        ttk.Entry(search_frame, textvariable=self.search_from, width=6).pack(side=tk.LEFT, padx=5)
+        ttk.Label(search_frame, text="To (min):").pack(side=tk.LEFT)
+        ttk.Entry(search_frame, textvariable=self.search_to, width=6).pack(side=tk.LEFT, padx=5)
+        ttk.Button(search_frame, text="Search", command=self.search).pack(side=tk.LEFT)
+
+        columns = ("session", "start", "sentiment", "transcription")
+        self.search_results = ttk.Treeview(parent, columns=columns, show="headings", height=6)
+        for column, width in zip(columns, (150, 70, 70, 600)):
+            self.search_results.heading(column, text=column.capitalize())
+            self.search_results.column(column, width=width, stretch=column == "transcription")
+        self.search_results.bind("<Double-1>", self.open_search_result)
+        self.search_results.pack(fill=tk.X, pady=5)
+
+    def search(self):
+        '''Queries the transcript index across all sessions. Fast enough to run on the UI thread'''
+        index = get_index()
+        if index is None:
+            messagebox.showerror("Error", "The search index is disabled (use_index in config.py).")
+            return
+        try:
+            start = float(self.search_from.get()) * 60 if self.search_from.get().strip() else None
+            end = float(self.search_to.get()) * 60 if self.search_to.get().strip() else None
+            sentiment = None if self.search_sentiment.get() == "All" else self.search_sentiment.get()
+            results = index.query(self.search_text.get().strip() or None, sentiment, start, end)
+        except Exception as e:
+            messagebox.showerror("Error", f"Search failed: {e}")
+            return
+
+        self.search_results.delete(*self.search_results.get_children())
+        for row in results.itertuples(index=False):
+            minutes, seconds = divmod(int(row.start or 0), 60)
+            self.search_results.insert("", tk.END, values=(row.session, f"{minutes}:{seconds:02d}", row.sentiment, row.transcription))
+        self.set_status(f"{len(results)} utterances found in {len(set(results['session']))} sessions")
+
+    def open_search_result(self, event):
+        '''Selects the session of a double-clicked search result for visualization'''
+        selection = self.search_results.selection()
+        if not selection:
+            return
+        session = self.search_results.item(selection[0], "values")[0]
+        for ext in (".parquet", ".csv"):
+            path = session_path(session, TRANSCRIBE_DIR, ext)
+            if os.path.exists(path):
+                self.file_path.set(path)
+                return
 
     def upload_file(self):
-        filetypes = [('CSV Files', '*.csv'), ('All Files', '*.*')]
+        filetypes = [('Transcription Files', '*.parquet *.csv'), ('Parquet Files', '*.parquet'), ('CSV Files', '*.csv'), ('All Files', '*.*')]
         selected_file = filedialog.askopenfilename(title="Select Transcription File", filetypes=filetypes)
         if selected_file:
             self.file_path.set(selected_file)
@@ -87,64 +161,94 @@ class CommunicationAnalysisApp:
             return
 
         try:
-            for widget in self.plot_frame.winfo_children():
-                widget.destroy()
-
-            output_dir = './plots'
-            os.makedirs(output_dir, exist_ok=True)
-
-            fig1 = generate_time_bucket_histogram(file_path)
-            histogram_path = os.path.join(output_dir, 'transcription_histogram.png')
-            fig1.savefig(histogram_path)
-            fig1.clf()
-
-            fig2 = generate_sentiment_visualization(file_path)
-            sentiment_path = os.path.join(output_dir, 'sentiment_distribution.png')
-            fig2.savefig(sentiment_path)
-            fig2.clf()
+            key = (file_path, os.path.getmtime(file_path))
+        except OSError as e:
+            messagebox.showerror("Error", f"Failed to generate visualizations: {e}")
+            return
 
-            self.display_image(histogram_path)
-            self.display_image(sentiment_path)
+        if key in self.figure_cache:
+            self.figure_cache.move_to_end(key)
+            self.display_figures(self.figure_cache[key])
+            self.set_status(f"Showing cached plots for {os.path.basename(file_path)}")
+            return
 
-            messagebox.showinfo("Success", "Visualizations generated and displayed successfully!")
+        self.generate_button.state(["disabled"])
+        self.set_status("Rendering...")
+        threading.Thread(target=self.render_figures, args=(key,), daemon=True).start()
+        self.master.after(100, self.poll_render_queue)
 
-        except Exception as e:
-            logging.error(f"Visualization generation failed: {e}")
-            messagebox.showerror("Error", f"Failed to generate visualizations: {e}")
-
-    def display_image(self, image_path):
+    def render_figures(self, key):
+        '''Runs on a background thread. Builds the figures without pyplot and reports progress through render_queue'''
+        file_path = key[0]
         try:
-            img = Image.open(image_path)
-            img = img.resize((500, 300), Image.LANCZOS)
-            img_tk = ImageTk.PhotoImage(img)
-            label = ttk.Label(self.plot_frame, image=img_tk)
-            label.image = img_tk
-            label.bind("<Button-1>", lambda e: self.open_zoomable_image(image_path))
-            label.pack(side=tk.TOP, fill=tk.BOTH, expand=True, pady=10)
-        except Exception as e:
-            logging.error(f"Failed to display image {image_path}: {e}")
-            messagebox.showerror("Error", f"Failed to display image: {e}")
-
-    def open_zoomable_image(self, image_path):
-        zoom_window = tk.Toplevel(self.master)
-        zoom_window.title("Zoomable Image")
+            self.render_queue.put(("status", f"Reading {os.path.basename(file_path)}..."))
+            df = read_session(file_path)
+            if 'start' not in df.columns or 'transcription' not in df.columns:
+                raise ValueError("'start' and 'transcription' columns are required")
 
-        canvas = tk.Canvas(zoom_window, bg="white")
-        scroll_x = tk.Scrollbar(zoom_window, orient="horizontal", command=canvas.xview)
-        scroll_y = tk.Scrollbar(zoom_window, orient="vertical", command=canvas.yview)
-        canvas.configure(xscrollcommand=scroll_x.set, yscrollcommand=scroll_y.set)
+            self.render_queue.put(("status", "Loading timeline levels..."))
+            pyramid = load_pyramid(file_path, df=df)
 
-        img = Image.open(image_path)
-        img_tk = ImageTk.PhotoImage(img)
+            # The timeline switches between the precomputed levels as it is zoomed, so any session length fits
+            self.render_queue.put(("status", "Rendering timeline..."))
+            figures = [timeline_figure(pyramid, title=os.path.splitext(os.path.basename(file_path))[0])]
 
-        canvas.create_image(0, 0, anchor="center", image=img_tk)
-        canvas.image = img_tk  # Keep a reference to avoid garbage collection
-        canvas.config(scrollregion=canvas.bbox("all"))
+            if 'sentiment' in df.columns:
+                self.render_queue.put(("status", "Rendering sentiment distribution..."))
+                figures.append(sentiment_figure(df['sentiment'].value_counts()))
 
-        canvas.pack(fill="both", expand=True)
-        scroll_x.pack(fill="x", side="bottom")
-        scroll_y.pack(fill="y", side="right")
+            self.render_queue.put(("done", key, figures))
+        except Exception as e:
+            self.render_queue.put(("error", key, e))
 
+    def poll_render_queue(self):
+        try:
+            while True:
+                message = self.render_queue.get_nowait()
+                if message[0] == "status":
+                    self.set_status(message[1])
+                    continue
+
+                self.generate_button.state(["!disabled"])
+                if message[0] == "done":
+                    _, key, figures = message
+                    self.cache_figures(key, figures)
+                    self.display_figures(figures)
+                    self.set_status(f"Visualizations generated for {os.path.basename(key[0])}")
+                    messagebox.showinfo("Success", "Visualizations generated and displayed successfully!")
+                else:
+                    _, key, e = message
+                    logging.error(f"Visualization generation failed: {e}")
+                    self.set_status("Ready")
+                    messagebox.showerror("Error", f"Failed to generate visualizations: {e}")
+                return
+        except queue.Empty:
+            self.master.after(100, self.poll_render_queue)
+
+    def cache_figures(self, key, figures):
+        '''Keeps the figures of the last MAX_CACHED_FIGURES sessions, replacing those of an older version of the same file'''
+        for stale in [k for k in self.figure_cache if k[0] == key[0]]:
+            del self.figure_cache[stale]
+        self.figure_cache[key] = figures
+        while len(self.figure_cache) > MAX_CACHED_FIGURES:
+            self.figure_cache.popitem(last=False)
+
+    def display_figures(self, figures):
+        for widget in self.plot_frame.winfo_children():
+            widget.destroy()
+
+        for fig in figures:
+            frame = ttk.Frame(self.plot_frame)
+            frame.pack(side=tk.TOP, fill=tk.BOTH, expand=True, pady=10)
+            canvas = FigureCanvasTkAgg(fig, master=frame)
+            toolbar = NavigationToolbar2Tk(canvas, frame, pack_toolbar=False)
+            toolbar.update()
+            toolbar.pack(side=tk.BOTTOM, fill=tk.X)
+            canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=True)
+            canvas.draw_idle()
+
+    def set_status(self, text):
+        self.status_label.config(text=text)
 
     def create_status_bar(self):
         status_frame = ttk.Frame(self.master)
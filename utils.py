@@ -1,7 +1,12 @@
 import os 
+import json
 import logging
+import wave
+import tempfile
+import subprocess
+import numpy as np
 from pydub import AudioSegment
-from config import split_length
+from config import split_length, sample_rate, decode_block_seconds, SEG_PATH
 
 logging.basicConfig(level=logging.INFO)
 
@@ -15,14 +20,49 @@ def read_directory(dir_path):
     logging.info(f" Found {len(video_files)} video files")
     return video_files
 
+def stream_pcm(media_path, sr = sample_rate, block_seconds = decode_block_seconds):
+    '''Generator that decodes any file ffmpeg can read to 16-bit mono PCM at sr and yields it as int16 blocks of
+    block_seconds, so memory use stays flat however long the recording is'''
+    cmd = ["ffmpeg", "-nostdin", "-loglevel", "error", "-i", media_path,
+           "-f", "s16le", "-acodec", "pcm_s16le", "-ac", "1", "-ar", str(sr), "-"]
+    block_bytes = int(sr * block_seconds) * 2
+    # stderr goes to a file, a pipe nobody reads would block ffmpeg once it fills up
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+        try:
+            while True:
+                data = proc.stdout.read(block_bytes)
+                if not data:
+                    break
+                yield np.frombuffer(data[:len(data) - len(data) % 2], dtype=np.int16)
+        finally:
+            proc.stdout.close()
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+        if proc.returncode != 0:
+            stderr.seek(0)
+            raise RuntimeError(f"ffmpeg failed on {media_path}: {stderr.read().decode(errors='replace').strip()}")
+
 def extract_audio(video_path, output_audio_path):
-    '''Extracts audio from the video file'''
+    '''Extracts audio from the video file as a 16 kHz mono WAV, streaming it through ffmpeg block by block.
+    The WAV is written under a temporary name and only moved into place once complete. Returns True on success'''
+    tmp_path = output_audio_path + '.tmp'
     try:
-        video = AudioSegment.from_file(video_path)
-        video.export(output_audio_path, format='wav')
+        with wave.open(tmp_path, 'wb') as wf:
+            wf.setnchannels(1)
+            wf.setsampwidth(2)
+            wf.setframerate(sample_rate)
+            for block in stream_pcm(video_path):
+                wf.writeframes(block.tobytes())
+        os.replace(tmp_path, output_audio_path)
         logging.info(f"Successfully extracted audio from {video_path} -> {output_audio_path}")
+        return True
     except Exception as e:
-        logging.error(f"Failed to extract audio from {video_path}")
+        logging.error(f"Failed to extract audio from {video_path} : {str(e)}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
 
 def video_to_audio(video_dir, output_dir):
     '''Function that goes through the directory and extracts audio from each video file'''
@@ -41,6 +81,9 @@ def video_to_audio(video_dir, output_dir):
         if not os.path.exists(full_path):
             logging.error(f"File {full_path} does not exist.Skipping...")
             continue
+        if os.path.exists(full_audio_path) and os.path.getmtime(full_audio_path) >= os.path.getmtime(full_path):
+            logging.info(f"{full_audio_path} is up to date.Skipping...")
+            continue
         extract_audio(full_path, full_audio_path)
 
 def split_audio(input_audio_dir, output_dir,split = split_length):
@@ -73,3 +116,94 @@ def split_audio(input_audio_dir, output_dir,split = split_length):
                 
         except Exception as e:
             logging.error(f"Failed to split {audio}")
+
+
+def load_audio(media_path, sr = sample_rate):
+    '''Function that decodes an audio or video file once into a mono float32 NumPy buffer at the given sample rate'''
+    blocks = [block.astype(np.float32) / 32768.0 for block in stream_pcm(media_path, sr=sr)]
+    if not blocks:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(blocks)
+
+def pcm_paths(media_path, store_dir = SEG_PATH):
+    '''Function that returns the array and sidecar paths of a recording in the PCM store'''
+    base_name = os.path.splitext(os.path.basename(media_path))[0]
+    return os.path.join(store_dir, base_name + '.npy'), os.path.join(store_dir, base_name + '.json')
+
+def _npy_header(n_samples):
+    return {"descr": np.lib.format.dtype_to_descr(np.dtype(np.float32)), "fortran_order": False, "shape": (n_samples,)}
+
+def write_pcm(media_path, store_dir = SEG_PATH, sr = sample_rate):
+    '''Function that decodes a recording once into <store_dir>/<name>.npy as float32 samples, block by block,
+    next to a <name>.json sidecar describing the source. Returns the sidecar dict'''
+    npy_path, meta_path = pcm_paths(media_path, store_dir)
+    os.makedirs(store_dir, exist_ok=True)
+    stat = os.stat(media_path)
+    n_samples = 0
+    try:
+        with open(npy_path + '.tmp', 'wb') as f:
+            # The length is only known at the end of the stream, so the header is written with a placeholder and
+            # rewritten afterwards. Any realistic length pads to the same header size
+            np.lib.format.write_array_header_1_0(f, _npy_header(2 ** 40))
+            data_offset = f.tell()
+            for block in stream_pcm(media_path, sr=sr):
+                f.write((block.astype(np.float32) / 32768.0).tobytes())
+                n_samples += len(block)
+            f.seek(0)
+            np.lib.format.write_array_header_1_0(f, _npy_header(n_samples))
+            if f.tell() != data_offset:
+                raise RuntimeError(f"Unexpected .npy header size for {n_samples} samples")
+    except BaseException:
+        os.remove(npy_path + '.tmp')
+        raise
+
+    meta = {"source": os.path.abspath(media_path), "source_mtime": stat.st_mtime, "source_size": stat.st_size,
+            "sample_rate": sr, "samples": n_samples, "duration": n_samples / sr, "dtype": "float32"}
+    os.replace(npy_path + '.tmp', npy_path)
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(meta_path + '.tmp', meta_path)
+    logging.info(f"Stored {meta['duration']:.1f}s of PCM from {media_path} in {npy_path}")
+    return meta
+
+def read_pcm_meta(media_path, store_dir = SEG_PATH):
+    '''Function that returns the sidecar dict of a stored recording, or None when it is not stored'''
+    _, meta_path = pcm_paths(media_path, store_dir)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        return json.load(f)
+
+def load_recording(media_path, store_dir = SEG_PATH, sr = sample_rate):
+    '''Function that returns a recording as a memory-mapped float32 array from the PCM store, decoding it
+    into the store first if it is missing, older than the source or was decoded from another file with the
+    same name. The map is copy-on-write, so slices are zero-copy views and the file is never modified'''
+    npy_path, _ = pcm_paths(media_path, store_dir)
+    meta = read_pcm_meta(media_path, store_dir)
+    stat = os.stat(media_path)
+    if (meta is None or not os.path.exists(npy_path) or meta["sample_rate"] != sr
+            or meta["source"] != os.path.abspath(media_path)
+            or meta["source_mtime"] != stat.st_mtime or meta["source_size"] != stat.st_size):
+        write_pcm(media_path, store_dir, sr)
+    return np.load(npy_path, mmap_mode='c')
+
+def read_range(media_path, start = 0.0, end = None, store_dir = SEG_PATH):
+    '''Function that returns the samples between start and end seconds of a stored recording as a zero-copy view'''
+    npy_path, _ = pcm_paths(media_path, store_dir)
+    sr = read_pcm_meta(media_path, store_dir)["sample_rate"]
+    audio = np.load(npy_path, mmap_mode='c')
+    return audio[int(start * sr):None if end is None else int(end * sr)]
+
+def chunk_ranges(n_samples, sr = sample_rate, split = split_length):
+    '''Function that returns the (start, end) sample ranges of split milliseconds each. Slicing the buffer with them gives views, not copies'''
+    step = int(sr * split / 1000)
+    return [(start, min(start + step, n_samples)) for start in range(0, n_samples, step)]
+
+def save_chunk(chunk, chunk_path, sr = sample_rate):
+    '''Function that writes a float32 chunk to a 16-bit mono WAV file'''
+    pcm = (np.clip(chunk, -1.0, 1.0) * 32767).astype(np.int16)
+    with wave.open(chunk_path, 'wb') as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(sr)
+        wf.writeframes(pcm.tobytes())
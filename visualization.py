@@ -1,14 +1,261 @@
 import pandas as pd
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.ticker import FuncFormatter
 import numpy as np
 import os
+import logging
 from config import TRANSCRIBE_DIR 
+from store import read_session
 
-files = os.listdir(TRANSCRIBE_DIR) # Take the first file for testing. In actual use case specify the file you want to transcribe
+SENTIMENTS = ["NEG", "NEU", "POS"]
+PYRAMID_LEVELS = (5, 30, 300, 3600)  # seconds per bucket of each precomputed timeline level, multiples of the first
+MAX_TIMELINE_BARS = 600  # the timeline uses the finest level that keeps the visible range under this many buckets
+SENTIMENT_COLORS = {"NEG": "#e74c3c", "NEU": "#95a5a6", "POS": "#2ecc71"}
+
+def list_sessions(transcribe_dir=TRANSCRIBE_DIR):
+    '''Function that returns one result file per session in the directory, preferring Parquet over CSV'''
+    if not os.path.exists(transcribe_dir):
+        return []
+    sessions = {}
+    for f in sorted(os.listdir(transcribe_dir)):
+        stem, ext = os.path.splitext(f)
+        if ext == ".parquet" or (ext == ".csv" and stem not in sessions):
+            sessions[stem] = os.path.join(transcribe_dir, f)
+    return [sessions[stem] for stem in sorted(sessions)]
+
+def aggregate_session(df, bucket_size=5):
+    '''Function that bins one session into bucket_size second buckets with NumPy.
+    Returns a dict of arrays: words and utterances per bucket, and sentiment counts per bucket
+    with one column per entry of SENTIMENTS'''
+    start = pd.to_numeric(df['start'], errors='coerce').to_numpy(dtype=float)
+    valid = np.isfinite(start) & (start >= 0)
+    start = start[valid]
+
+    n_buckets = max(int(np.ceil(start.max() / bucket_size)), 1) if len(start) else 0
+    idx = np.minimum((start // bucket_size).astype(np.int64), n_buckets - 1)
+
+    word_counts = df['transcription'].fillna("").astype(str).str.count(r"\S+").to_numpy()[valid]
+    words = np.bincount(idx, weights=word_counts, minlength=n_buckets).astype(np.int64)
+    utterances = np.bincount(idx, minlength=n_buckets)
+
+    sentiment = np.zeros((n_buckets, len(SENTIMENTS)), dtype=np.int64)
+    if 'sentiment' in df.columns:
+        codes = pd.Categorical(df['sentiment'], categories=SENTIMENTS).codes[valid]
+        labelled = codes >= 0
+        flat = np.bincount(idx[labelled] * len(SENTIMENTS) + codes[labelled], minlength=n_buckets * len(SENTIMENTS))
+        sentiment = flat.reshape(n_buckets, len(SENTIMENTS))
+
+    return {"bucket_size": bucket_size, "words": words, "utterances": utterances, "sentiment": sentiment}
+
+def _add_aggregates(total, agg):
+    '''Function that sums two aggregates of the same bucket size, padding the shorter one'''
+    if total is None:
+        return {key: (value.copy() if isinstance(value, np.ndarray) else value) for key, value in agg.items()}
+    n = max(len(total["words"]), len(agg["words"]))
+    summed = {"bucket_size": total["bucket_size"]}
+    for key in ("words", "utterances", "sentiment"):
+        pad = [(0, n - len(total[key]))] + [(0, 0)] * (total[key].ndim - 1)
+        summed[key] = np.pad(total[key], pad)
+        summed[key][:len(agg[key])] += agg[key]
+    return summed
+
+def _speech_end(df):
+    '''Function that returns the session time in seconds at which the last utterance ends'''
+    times = pd.to_numeric(df['end'] if 'end' in df.columns else df['start'], errors='coerce')
+    return round(float(times.max()), 3) if times.notna().any() else 0.0
+
+def aggregate_sessions(paths, bucket_size=5):
+    '''Function that streams over session files one at a time, reading only the columns it needs.
+    Returns the aggregate summed across sessions (aligned on session time) and a DataFrame with
+    one summary row per session. The recording length is not stored with a session, so speech_end,
+    the end of the last utterance, stands in for it'''
+    total = None
+    summary = []
+    for path in paths:
+        df = read_session(path, columns=['start', 'end', 'transcription', 'sentiment'])
+        agg = aggregate_session(df, bucket_size)
+        total = _add_aggregates(total, agg)
+        row = {"session": os.path.splitext(os.path.basename(path))[0],
+               "speech_end": _speech_end(df),
+               "utterances": int(agg["utterances"].sum()),
+               "words": int(agg["words"].sum())}
+        row.update(zip(SENTIMENTS, agg["sentiment"].sum(axis=0).tolist()))
+        summary.append(row)
+    return total, pd.DataFrame(summary, columns=["session", "speech_end", "utterances", "words"] + SENTIMENTS)
+
+def _coarsen(agg, factor, bucket_size):
+    '''Function that sums every factor consecutive buckets of an aggregate into one'''
+    n = -(-len(agg["words"]) // factor)
+    coarse = {"bucket_size": bucket_size}
+    for key in ("words", "utterances", "sentiment"):
+        value = agg[key]
+        pad = [(0, n * factor - len(value))] + [(0, 0)] * (value.ndim - 1)
+        coarse[key] = np.pad(value, pad).reshape(n, factor, *value.shape[1:]).sum(axis=1)
+    return coarse
+
+def build_pyramid(df, levels=PYRAMID_LEVELS):
+    '''Function that aggregates a session once at the finest level and sums it up into every coarser level.
+    Returns {bucket_size: aggregate}'''
+    if any(level % levels[0] for level in levels):
+        raise ValueError(f"Pyramid levels {levels} must be multiples of {levels[0]}")
+    base = aggregate_session(df, levels[0])
+    return {level: _coarsen(base, level // levels[0], level) for level in levels}
+
+def pyramid_path(session_file):
+    '''Function that returns where the pyramid of a session file is stored, next to the transcript'''
+    return os.path.splitext(session_file)[0] + ".pyramid.npz"
+
+def save_pyramid(pyramid, path):
+    '''Function that writes a pyramid as one .npz with words, utterances and sentiment arrays per level'''
+    arrays = {f"{level}_{key}": agg[key] for level, agg in pyramid.items() for key in ("words", "utterances", "sentiment")}
+    with open(path + ".tmp", "wb") as f:
+        np.savez(f, levels=np.array(sorted(pyramid)), **arrays)
+    os.replace(path + ".tmp", path)
+
+def save_session_pyramid(rows, session, store_dir=TRANSCRIBE_DIR):
+    '''Function that precomputes the pyramid of a session as it is saved. Failures are logged, never raised'''
+    try:
+        save_pyramid(build_pyramid(pd.DataFrame(rows, columns=['start', 'transcription', 'sentiment'])),
+                     pyramid_path(os.path.join(store_dir, session)))
+    except Exception as e:
+        logging.error(f"Failed to build the timeline pyramid of {session} : {str(e)}")
+
+def load_pyramid(session_file, levels=PYRAMID_LEVELS, df=None):
+    '''Function that returns the pyramid of a session file, rebuilding and storing it when it is missing,
+    older than the transcript or has other levels. df, if given, saves reading the transcript again'''
+    path = pyramid_path(session_file)
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(session_file):
+        with np.load(path) as data:
+            if data["levels"].tolist() == sorted(levels):
+                return {level: {"bucket_size": level, **{key: data[f"{level}_{key}"] for key in ("words", "utterances", "sentiment")}}
+                        for level in levels}
+
+    if df is None:
+        df = read_session(session_file, columns=['start', 'transcription', 'sentiment'])
+    pyramid = build_pyramid(df, levels)
+    save_pyramid(pyramid, path)
+    return pyramid
+
+def _format_time(seconds, _=None):
+    hours, rest = divmod(int(seconds), 3600)
+    return f"{hours}:{rest // 60:02d}:{rest % 60:02d}" if hours else f"{rest // 60:02d}:{rest % 60:02d}"
+
+class TimelineView:
+    '''Words per bucket and sentiment mix of one session on a shared numeric time axis. Whenever the view
+    is zoomed or panned it switches to the pyramid level that fits the visible range and draws only that
+    range (plus a margin for panning) as two step artists, so any session length renders instantly.'''
+
+    def __init__(self, fig, pyramid, title='Session Timeline', max_bars=MAX_TIMELINE_BARS):
+        self.fig = fig
+        self.pyramid = pyramid
+        self.levels = sorted(pyramid)
+        self.title = title
+        self.max_bars = max_bars
+        self.artists = []
+        self.drawn = None  # (level, start, end) of what is currently drawn
+
+        self.words_ax, self.sentiment_ax = fig.subplots(2, 1, sharex=True, height_ratios=[2, 1])
+        finest = pyramid[self.levels[0]]
+        self.duration = max(len(finest["words"]) * self.levels[0], self.levels[0])
+        self.words_ax.set_xlim(0, self.duration)
+        self.words_ax.set_ylabel('Number of Words')
+        self.sentiment_ax.set_ylabel('Utterances')
+        self.sentiment_ax.set_xlabel('Session Time')
+        self.sentiment_ax.xaxis.set_major_formatter(FuncFormatter(_format_time))
+        self.sentiment_ax.legend(handles=[plt.Rectangle((0, 0), 1, 1, color=SENTIMENT_COLORS[label]) for label in SENTIMENTS],
+                                 labels=SENTIMENTS, loc='upper right')
+        self.update()
+        self.words_ax.callbacks.connect('xlim_changed', lambda ax: self.update())
+
+    def level_for(self, span):
+        '''Returns the finest level that shows span seconds in at most max_bars buckets'''
+        for level in self.levels:
+            if span / level <= self.max_bars:
+                return level
+        return self.levels[-1]
+
+    def update(self):
+        lo, hi = self.words_ax.get_xlim()
+        span = max(hi - lo, 1e-9)
+        level = self.level_for(span)
+        if self.drawn and self.drawn[0] == level and self.drawn[1] <= max(lo, 0) and min(hi, self.duration) <= self.drawn[2]:
+            return
+
+        agg = self.pyramid[level]
+        first = max(int((lo - span) // level), 0)
+        last = min(int((hi + span) // level) + 1, len(agg["words"]))
+        for artist in self.artists:
+            artist.remove()
+        self.artists = []
+        if last > first:
+            edges = np.arange(first, last + 1) * level
+            words = agg["words"][first:last]
+            self.artists.append(self.words_ax.stairs(words, edges, fill=True, color='skyblue'))
+            stacked = np.cumsum(agg["sentiment"][first:last], axis=1)
+            for k, label in enumerate(SENTIMENTS):
+                baseline = stacked[:, k - 1] if k else 0
+                self.artists.append(self.sentiment_ax.stairs(stacked[:, k], edges, baseline=baseline, fill=True,
+                                                             color=SENTIMENT_COLORS[label]))
+            self.words_ax.set_ylim(0, max(int(words.max()), 1) * 1.1)
+            self.sentiment_ax.set_ylim(0, max(int(stacked[:, -1].max()), 1) * 1.1)
+        self.words_ax.set_title(f"{self.title} ({_format_time(level)} buckets)")
+        self.drawn = (level, first * level, last * level)
+        if self.fig.canvas is not None:
+            self.fig.canvas.draw_idle()
+
+def timeline_figure(pyramid, title='Session Timeline'):
+    '''Function to build the zoomable session timeline as a standalone Figure, safe to call from a background thread.
+    The view stays alive through its xlim callback, which holds the only reference to it'''
+    fig = Figure(figsize=(12, 6))
+    TimelineView(fig, pyramid, title)
+    return fig
+
+def _draw_word_buckets(ax, agg, title):
+    edges = np.arange(len(agg["words"]) + 1) * agg["bucket_size"]
+    ax.stairs(agg["words"], edges, fill=True, color='skyblue')
+    ax.set_xlim(0, max(edges[-1], agg["bucket_size"]))
+    ax.set_title(f"{title} ({_format_time(agg['bucket_size'])} buckets)")
+    ax.set_xlabel('Session Time')
+    ax.set_ylabel('Number of Words')
+    ax.xaxis.set_major_formatter(FuncFormatter(_format_time))
+
+def _draw_sentiment_counts(ax, sentiment_counts, title):
+    ax.pie(sentiment_counts, labels=sentiment_counts.index, autopct='%1.1f%%')
+    ax.set_title(title)
+
+def plot_word_buckets(agg, title='Words per Time Bucket'):
+    '''Function to plot the words per bucket of an aggregate'''
+    plt.figure(figsize=(12, 6))
+    _draw_word_buckets(plt.gca(), agg, title)
+    plt.tight_layout()
+
+    return plt
+
+def plot_sentiment_counts(sentiment_counts, title='Sentiment Distribution'):
+    '''Function to plot a pie chart from a Series of counts indexed by sentiment label'''
+    plt.figure(figsize=(10, 7))
+    _draw_sentiment_counts(plt.gca(), sentiment_counts, title)
+
+    return plt
+
+def word_buckets_figure(agg, title='Words per Time Bucket'):
+    '''Function to build the words per bucket plot as a standalone Figure. It does not touch pyplot,
+    so it is safe to call from a background thread'''
+    fig = Figure(figsize=(12, 6))
+    _draw_word_buckets(fig.add_subplot(), agg, title)
+    fig.tight_layout()
+    return fig
+
+def sentiment_figure(sentiment_counts, title='Sentiment Distribution'):
+    '''Function to build the sentiment pie chart as a standalone Figure, safe to call from a background thread'''
+    fig = Figure(figsize=(10, 7))
+    _draw_sentiment_counts(fig.add_subplot(), sentiment_counts, title)
+    return fig
 
 def generate_time_bucket_histogram(csv_path, bucket_size=5):
     '''Function to generate the histogram for 5 second buckets'''
-    df = pd.read_csv(csv_path)
+    df = read_session(csv_path)
 
     if 'start' not in df.columns:
         print("Error : 'start' column not found.")
@@ -18,60 +265,23 @@ def generate_time_bucket_histogram(csv_path, bucket_size=5):
         print("Error: 'transcription' column not found in CSV.")
         return None
 
-    df = df[pd.to_numeric(df['start'], errors='coerce').notnull()]
-    df['start'] = df['start'].astype(float)
-    df = df[np.isfinite(df['start'])]
-
-    max_time = df['start'].max()
-    print(f"Max Time : {max_time}")
-    if max_time > 10000:
-        print(f"Warning: Skipping histogram generation. max_time={max_time} is too large.")
-        return None
-
-    # Generate bucket edges and labels
-    buckets = np.arange(0, max_time + bucket_size, bucket_size)
-    bucket_labels = [
-        f"{int(start // 60):02d}:{int(start % 60):02d}-{int((start + bucket_size) // 60):02d}:{int((start + bucket_size) % 60):02d}"
-        for start in buckets[:-1]
-    ]
-
-    # Aggregate words into buckets
-    bucket_counts = [0] * (len(buckets) - 1)
-    for _, row in df.iterrows():
-        start_time = row['start']
-        word_count = len(str(row['transcription']).split())
+    agg = aggregate_session(df, bucket_size)
 
-        bucket_index = min(int(start_time // bucket_size), len(bucket_counts) - 1)
-        bucket_counts[bucket_index] += word_count
+    print(f"Max Time : {len(agg['words']) * bucket_size}")
 
-    # Plotting
-    plt.figure(figsize=(12, 6))
-    plt.bar(bucket_labels, bucket_counts, color='skyblue')
-    plt.title('Words per Time Bucket')
-    plt.xlabel('Time Buckets')
-    plt.ylabel('Number of Words')
-    plt.xticks(rotation=45, ha='right')
-    plt.tight_layout()
-
-    return plt
+    return plot_word_buckets(agg)
 
 
 def generate_sentiment_visualization(csv_path):
     '''Function to generate a pie chart of sentiment distribution'''
 
-    df = pd.read_csv(csv_path)
+    df = read_session(csv_path)
     
     if 'sentiment' not in df.columns:
         print("Warning: No sentiment data found!")
         return None
     
-    sentiment_counts = df['sentiment'].value_counts()
-    
-    plt.figure(figsize=(10, 7))
-    plt.pie(sentiment_counts, labels=sentiment_counts.index, autopct='%1.1f%%')
-    plt.title('Sentiment Distribution')
-      
-    return plt
+    return plot_sentiment_counts(df['sentiment'].value_counts())
 
 def save_plots(csv_path, output_dir='./plots'):
     '''Function to save plots in a folder'''
@@ -93,5 +303,25 @@ def save_plots(csv_path, output_dir='./plots'):
     except Exception as e:
         print(f"Error generating sentiment plot: {e}")
 
+def save_summary_plots(transcribe_dir=TRANSCRIBE_DIR, output_dir='./plots', bucket_size=60):
+    '''Function to save cross-session plots and a per-session summary table for every session in the directory'''
+    os.makedirs(output_dir, exist_ok=True)
+
+    total, summary = aggregate_sessions(list_sessions(transcribe_dir), bucket_size)
+    if total is None:
+        print(f"No sessions found in {transcribe_dir}")
+        return None
+    summary.to_csv(os.path.join(output_dir, 'session_summary.csv'), index=False)
+
+    histogram_plot = plot_word_buckets(total, title=f'Words per Time Bucket, all {len(summary)} sessions')
+    histogram_plot.savefig(os.path.join(output_dir, 'transcription_histogram_all.png'))
+    histogram_plot.close()
+
+    sentiment_plot = plot_sentiment_counts(summary[SENTIMENTS].sum(), title=f'Sentiment Distribution, all {len(summary)} sessions')
+    sentiment_plot.savefig(os.path.join(output_dir, 'sentiment_distribution_all.png'))
+    sentiment_plot.close()
+
+    return summary
+
 if __name__ == "__main__": 
-    save_plots(os.path.join(TRANSCRIBE_DIR,files[0]))
\ No newline at end of file
+    save_summary_plots(TRANSCRIBE_DIR)
\ No newline at end of file